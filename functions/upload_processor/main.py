@@ -890,6 +890,7 @@ def assign_links_from_business_file(path: str, base_url: str,
                 customer_business_ref = db.collection('customers').document(ownerId).collection('businesses').document(biz_id)
                 batch.set(customer_business_ref, {
                     "business_ref": biz_ref,
+                    "business_id": biz_id,  # Lets overlays be queried by business (collection group index)
                     **customer_payload
                 }, merge=True); ops += 1
 
@@ -1,10 +1,22 @@
-# pip install google-cloud-firestore tqdm
-
-from hashlib import sha1
+# pip install google-cloud-firestore tqdm pandas
+
+import json
+import logging
+import logging.handlers
+import sqlite3
+import sys
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from hashlib import blake2b, sha1
+from itertools import islice
 from datetime import datetime, timezone
 
+import pandas as pd
 from google.cloud import firestore
 from google.cloud.firestore import Client
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions, SendMode
 from tqdm import tqdm
 
 # =====================
@@ -25,7 +37,9 @@ PRINT_LIMIT_HITS      = 5
 PRINT_LIMIT_CREATIONS = 20
 
 # Process only part of the data (fast tests)
-FILTER_CAMPAIGN_CODE = None     # e.g. "groessig-01"; set to None to disable filtering
+# Server-side filter on the SRC 'campaign' field: a code, a list of up to 30 codes, or None.
+# None scans everything (new-schema SRC docs may have no 'campaign' field at all).
+FILTER_CAMPAIGN_CODE = None     # e.g. "groessig-01" or ["groessig-01", "groessig-02"]
 LINK_LIMIT = 100              # 0 => process all matched links
 HIT_LIMIT  = 60                # 0 => process all matched hits
 
@@ -45,126 +59,542 @@ CUSTOMER_OWNER_MAP = {
     # add others as needed
 }
 
+# Hit fields copied verbatim from SRC to DST
+HIT_PASSTHROUGH = (
+    "device_type", "geo_city", "geo_country", "geo_lat", "geo_lon", "geo_region",
+    "geo_source", "ip_hash", "ua_browser", "ua_os", "user_agent",
+)
+
+# Only these fields are read from SRC hits (server-side projection)
+HIT_SRC_FIELDS = ("business_id", "campaign", "link_id", "template", "ts") + HIT_PASSTHROUGH
+
 # Prefer resolving hits from already-migrated DST links; fall back to SRC during DRY runs
 PREFER_DST_LINK_LOOKUP = True
 
+# Count per-campaign unique_ips with a HyperLogLog++ sketch (~1% error, fixed ~16KB per
+# campaign) instead of an exact set of ip hashes. Needs: pip install datasketch
+UNIQUE_IPS_SKETCH = False
+
+# Run the links and hits passes concurrently. Hits whose link is not in DST yet resolve
+# owner/campaign through the SRC fallback, which can differ from what migrate_links writes
+# (d["campaign"] + CUSTOMER_OWNER_MAP), so attribution would depend on timing. Only enable
+# when the links are already migrated.
+PARALLEL_PHASES = False
+
+# Per-campaign summary is also written here for diffing between runs (None to disable)
+SUMMARY_CSV_PATH = "migration_summary.csv"
+
+# Resumable runs (opt-in): with RESUME = True, migrated doc ids are recorded in a local
+# SQLite file and later runs only stream SRC docs after the last recorded id. Checkpoints
+# are kept per collection and FILTER_CAMPAIGN_CODE/LINK_LIMIT/HIT_LIMIT, so a filtered or
+# limited test run never moves the cursor of a full run.
+# A pass that completes cleanly (no failed writes, not cut short by its limit) clears its
+# checkpoint. RESET_CHECKPOINT = True clears all of them (local and in DST) before the run.
+RESUME = False
+RESET_CHECKPOINT = False
+CHECKPOINT_DB_PATH = ".migrate_state.db"
+# The last checkpointed id per collection is mirrored to {this}/{col}_cursor in DST (None to disable)
+CURSOR_STATE_COLLECTION = "_migration_state"
+
+# BulkWriter: flush (and checkpoint) after this many enqueued writes
+BULK_FLUSH_EVERY = 2000
+BULK_MAX_ATTEMPTS = 15
+
+# Hits are streamed; links for the next N hits are bulk-prefetched before processing them
+HIT_LOOKAHEAD = 500
+# Worker threads resolving owner/campaign/target per hit (writes stay on the main thread)
+HIT_WORKERS = 20
+# Merge hits/unique_ips totals of touched campaigns into DST every N migrated hits
+TOTALS_FLUSH_EVERY = 5000
+# Concurrent get_all() chunks for link/campaign prefetches
+LOOKUP_WORKERS = 8
+
 # =====================
 # Firestore clients
 # =====================
 SRC_DB: Client = firestore.Client(project=PROJECT_ID_PROD, database=SRC_DATABASE_ID)
 DST_DB: Client = firestore.Client(project=PROJECT_ID_DEV, database=DST_DATABASE_ID)
+_dst_hits_col = DST_DB.collection(HITS_DST)
+
+# =====================
+# Logging (hot-loop diagnostics are buffered and flushed in chunks)
+# =====================
+logger = logging.getLogger("migrate_schema_v2")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("%(message)s"))
+_log_buffer = logging.handlers.MemoryHandler(1024, flushLevel=logging.ERROR, target=_log_stream)
+logger.addHandler(_log_buffer)
 
 # =====================
 # Counters
 # =====================
 COUNTERS = {
     "links_scanned": 0, "links_printed": 0, "links_suppressed": 0, "links_migrated": 0,
+    "links_unchanged": 0,
     "hits_scanned": 0,  "hits_printed": 0,  "hits_suppressed": 0,  "hits_migrated": 0,
     "campaigns_ensured_unique": 0, "campaigns_created": 0, "campaigns_creation_logs": 0,
     "targets_ensured_unique": 0,   "targets_created": 0,   "targets_creation_logs": 0,
 }
 _seen_campaign_ids = set()
 _seen_target_ids = set()
+_resumed_collections = set()
+_counters_lock = threading.Lock()   # BulkWriter callbacks and hit workers run on other threads
+_lookup_pool = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS)
+
+# Existing DST campaign ids / target paths (preloaded once, backfilled on create)
+_existing_campaign_ids = set()
+_existing_target_paths = set()
+
+# =====================
+# Checkpoint (local SQLite)
+# =====================
+_checkpoint_con = None
+_checkpoint_lock = threading.Lock()   # links and hits phases may run on separate threads
+_checkpoint_stop = {}   # checkpoint key -> lowest doc id whose write failed in this run
+
+def checkpoint_enabled() -> bool:
+    return bool(RESUME and CHECKPOINT_DB_PATH and not DRY_RUN)
+
+def checkpoint_settings(col: str) -> str:
+    """The filter/limit settings that decide which docs a run streams from this collection."""
+    codes = FILTER_CAMPAIGN_CODE
+    if codes and not isinstance(codes, str):
+        codes = sorted(codes)
+    limit = (LINK_LIMIT if col == LINKS_SRC else HIT_LIMIT) or 0
+    return json.dumps({"campaign": codes, "limit": limit}, sort_keys=True)
+
+def checkpoint_key(col: str) -> str:
+    """Checkpoint key: the collection plus a digest of its filter/limit settings."""
+    digest = blake2b(checkpoint_settings(col).encode("utf-8"), digest_size=6).hexdigest()
+    return f"{col}_{digest}"
+
+def checkpoint_db():
+    global _checkpoint_con
+    if _checkpoint_con is None:
+        _checkpoint_con = sqlite3.connect(CHECKPOINT_DB_PATH, check_same_thread=False)
+        _checkpoint_con.execute(
+            "CREATE TABLE IF NOT EXISTS done(col TEXT, id TEXT, PRIMARY KEY(col, id))"
+        )
+    return _checkpoint_con
+
+def remote_cursor_ref(col: str):
+    return DST_DB.collection(CURSOR_STATE_COLLECTION).document(f"{checkpoint_key(col)}_cursor")
+
+def checkpoint_last_id(col: str):
+    """
+    Highest doc id already migrated for this collection and settings (None => full scan).
+    Takes the further of the local SQLite checkpoint and the cursor doc in DST,
+    so a run can also resume from another machine.
+    """
+    if not checkpoint_enabled():
+        return None
+    key = checkpoint_key(col)
+    with _checkpoint_lock:
+        row = checkpoint_db().execute("SELECT MAX(id) FROM done WHERE col = ?", (key,)).fetchone()
+    local_id = row[0] if row else None
+    remote_id = None
+    if CURSOR_STATE_COLLECTION:
+        snap = remote_cursor_ref(col).get()
+        remote_id = (snap.to_dict() or {}).get("last_id") if snap.exists else None
+    return max(filter(None, (local_id, remote_id)), default=None)
+
+def checkpoint_mark(col: str, ids, failed_ids=()):
+    """
+    Record doc ids whose writes were committed to DST (locally and in the DST cursor doc).
+    The cursor never passes a failed write: ids from the lowest failed id on are not
+    recorded, so the next resumed run streams (and retries) them again.
+    """
+    if not checkpoint_enabled():
+        return
+    key = checkpoint_key(col)
+    with _checkpoint_lock:
+        if failed_ids:
+            _checkpoint_stop[key] = min(filter(None, (_checkpoint_stop.get(key), *failed_ids)))
+        stop = _checkpoint_stop.get(key)
+        if stop is not None:
+            ids = [i for i in ids if i < stop]
+        if not ids:
+            return
+        con = checkpoint_db()
+        with con:
+            con.executemany("INSERT OR IGNORE INTO done(col, id) VALUES (?, ?)",
+                            [(key, i) for i in ids])
+        last_id = con.execute("SELECT MAX(id) FROM done WHERE col = ?", (key,)).fetchone()[0]
+    if CURSOR_STATE_COLLECTION:
+        remote_cursor_ref(col).set({"last_id": last_id, "settings": checkpoint_settings(col),
+                                    "last_ts": datetime.now(timezone.utc)})
+
+def checkpoint_clear(col: str):
+    """Drop the checkpoint of a pass that completed cleanly, so the next run is a full scan."""
+    if not checkpoint_enabled():
+        return
+    key = checkpoint_key(col)
+    with _checkpoint_lock:
+        if key in _checkpoint_stop:
+            return   # a write failed; keep the cursor in front of it
+        con = checkpoint_db()
+        with con:
+            con.execute("DELETE FROM done WHERE col = ?", (key,))
+    if CURSOR_STATE_COLLECTION:
+        remote_cursor_ref(col).delete()
+
+def reset_checkpoints():
+    """Clear every checkpoint, in the local SQLite file and the cursor docs in DST."""
+    if DRY_RUN:
+        print("DRY RUN: would reset all checkpoints")
+        return
+    if CHECKPOINT_DB_PATH:
+        with _checkpoint_lock:
+            con = checkpoint_db()
+            with con:
+                con.execute("DELETE FROM done")
+    if CURSOR_STATE_COLLECTION:
+        for ref in DST_DB.collection(CURSOR_STATE_COLLECTION).list_documents():
+            ref.delete()
+    print("Checkpoints reset (local and DST)")
+
+def campaign_filter(q):
+    """
+    Apply FILTER_CAMPAIGN_CODE server-side. Several codes use one 'in' query so the
+    stream stays a single __name__-ordered cursor (served by single-field indexes).
+    """
+    codes = FILTER_CAMPAIGN_CODE
+    if not codes:
+        return q
+    if isinstance(codes, str):
+        return q.where("campaign", "==", codes)
+    codes = list(codes)
+    if len(codes) > 30:
+        raise ValueError("FILTER_CAMPAIGN_CODE supports at most 30 codes ('in' query limit)")
+    return q.where("campaign", "in", codes)
+
+def resume_query(q, col: str):
+    """Order by doc id and skip everything up to the last checkpointed id."""
+    if not checkpoint_enabled():
+        return q
+    q = q.order_by("__name__")
+    last_id = checkpoint_last_id(col)
+    if last_id:
+        print(f"Resuming {col} after checkpointed id {last_id}")
+        _resumed_collections.add(col)
+        q = q.start_after({"__name__": SRC_DB.collection(col).document(last_id)})
+    return q
 
 # =====================
 # Helpers
 # =====================
-def stable_id(*parts: str) -> str:
+@lru_cache(maxsize=None)
+def _stable_id_prefix(first: str):
+    """sha1 state after hashing the leading part (owner/campaign id), reused via copy()."""
     h = sha1()
-    for p in parts:
+    h.update(first.encode("utf-8")); h.update(b"|")
+    return h
+
+def stable_id(first: str, *rest: str) -> str:
+    h = _stable_id_prefix(first).copy()
+    for p in rest:
         h.update(p.encode("utf-8")); h.update(b"|")
     return h.hexdigest()[:20]
 
+def progress(iterable, desc: str, unit: str):
+    """tqdm with throttled refreshes; silent when stderr is not a terminal (nohup/CI)."""
+    return tqdm(iterable, desc=desc, unit=unit, file=sys.stderr,
+                mininterval=1.0, miniters=500, smoothing=0,
+                disable=not sys.stderr.isatty())
+
+def write_order_key(doc_id: str) -> str:
+    """Sort key that spreads sequential doc ids across the key space (avoids write hotspots)."""
+    return blake2b(doc_id.encode("utf-8"), digest_size=1).hexdigest() + doc_id
+
+@lru_cache(maxsize=None)
 def dst_business_ref(business_id: str):
+    # business ids repeat heavily across links/hits; build each reference once per run
     return DST_DB.collection(BUSINESSES_DST).document(business_id)
 
 def src_business_doc(business_id: str):
     return SRC_DB.collection(BUSINESSES_SRC).document(business_id)
 
+def preload_dst_campaigns():
+    """
+    Load ids of existing DST campaigns and target paths in two name-only scans so
+    ensure_campaign/ensure_target never need a per-key .get().
+    """
+    for snap in DST_DB.collection(CAMPAIGNS_DST).select([]).stream():
+        _existing_campaign_ids.add(snap.id)
+    for snap in DST_DB.collection_group("targets").select([]).stream():
+        _existing_target_paths.add(snap.reference.path)
+    print(f"Preloaded {len(_existing_campaign_ids)} campaigns / {len(_existing_target_paths)} targets (DST)")
+
+def _claim_new(existing: set, key: str) -> bool:
+    """True if key was not known yet (caller creates it); marks it as existing."""
+    with _counters_lock:
+        if key in existing:
+            return False
+        existing.add(key)
+        return True
+
+def _log_ensure(kind: str, created: bool, detail: str):
+    with _counters_lock:
+        logs = COUNTERS[f"{kind}s_creation_logs"]
+        if logs <= PRINT_LIMIT_CREATIONS:
+            COUNTERS[f"{kind}s_creation_logs"] += 1
+    if logs < PRINT_LIMIT_CREATIONS:
+        print(("[OK] Created" if created else "[=] Ensured") + f" {kind} {detail}")
+    elif logs == PRINT_LIMIT_CREATIONS:
+        print(f"... further {kind} ensure/create logs suppressed ...")
+
 def ensure_campaign(owner_id: str, code: str, now_ts):
-    """Ensure campaign in DST_DB. Returns (campaign_ref, created_bool)."""
+    """Ensure campaign in DST_DB. Returns (campaign_ref, created_bool). Thread-safe."""
     doc_id = stable_id(owner_id, code)
     cref = DST_DB.collection(CAMPAIGNS_DST).document(doc_id)
 
-    if doc_id not in _seen_campaign_ids:
-        _seen_campaign_ids.add(doc_id)
-        COUNTERS["campaigns_ensured_unique"] += 1
+    with _counters_lock:
+        if doc_id not in _seen_campaign_ids:
+            _seen_campaign_ids.add(doc_id)
+            COUNTERS["campaigns_ensured_unique"] += 1
 
-    snap = cref.get()
     created = False
-    if not snap.exists and not DRY_RUN:
+    if _claim_new(_existing_campaign_ids, doc_id) and not DRY_RUN:
         cref.set({
             "code": code, "name": code, "owner_id": owner_id, "status": "draft",
             "created_at": now_ts, "updated_at": now_ts,
             "totals": {"hits": 0, "links": 0, "targets": 0, "unique_ips": 0}
         })
         created = True
-        COUNTERS["campaigns_created"] += 1
-
-    if COUNTERS["campaigns_creation_logs"] < PRINT_LIMIT_CREATIONS:
-        print(("[OK] Created" if created else "[=] Ensured")
-              + f" campaign '{code}' id={cref.id} owner={owner_id}")
-        COUNTERS["campaigns_creation_logs"] += 1
-    elif COUNTERS["campaigns_creation_logs"] == PRINT_LIMIT_CREATIONS:
-        print("... further campaign ensure/create logs suppressed ...")
-        COUNTERS["campaigns_creation_logs"] += 1
+    if created:
+        with _counters_lock:
+            COUNTERS["campaigns_created"] += 1
 
+    _log_ensure("campaign", created, f"'{code}' id={cref.id} owner={owner_id}")
     return cref, created
 
 def ensure_target(campaign_ref, business_id: str, now_ts):
-    """Ensure target subdoc in DST_DB under the given campaign."""
+    """Ensure target subdoc in DST_DB under the given campaign. Thread-safe."""
     tid = stable_id(campaign_ref.id, business_id)
     tref = campaign_ref.collection("targets").document(tid)
 
-    if tid not in _seen_target_ids:
-        _seen_target_ids.add(tid)
-        COUNTERS["targets_ensured_unique"] += 1
+    with _counters_lock:
+        if tid not in _seen_target_ids:
+            _seen_target_ids.add(tid)
+            COUNTERS["targets_ensured_unique"] += 1
 
-    snap = tref.get()
     created = False
-    if not snap.exists and not DRY_RUN:
+    if _claim_new(_existing_target_paths, tref.path) and not DRY_RUN:
         tref.set({
             "business_id": business_id,
             "business_ref": dst_business_ref(business_id),
             "created_at": now_ts, "updated_at": now_ts,
         })
         created = True
-        COUNTERS["targets_created"] += 1
-
-    if COUNTERS["targets_creation_logs"] < PRINT_LIMIT_CREATIONS:
-        print(("[OK] Created" if created else "[=] Ensured")
-              + f" target id={tref.id} for campaign={campaign_ref.id} business={business_id}")
-        COUNTERS["targets_creation_logs"] += 1
-    elif COUNTERS["targets_creation_logs"] == PRINT_LIMIT_CREATIONS:
-        print("... further target ensure/create logs suppressed ...")
-        COUNTERS["targets_creation_logs"] += 1
+    if created:
+        with _counters_lock:
+            COUNTERS["targets_created"] += 1
 
+    _log_ensure("target", created, f"id={tref.id} for campaign={campaign_ref.id} business={business_id}")
     return tref, created
 
+# Fields that change on every run and must not affect the payload hash
+_HASH_VOLATILE_FIELDS = ("created_at", "updated_at")
+
+def payload_hash(data: dict) -> str:
+    """Stable hash of a DST payload (refs by path), stored as _migration_hash."""
+    stable = {k: v for k, v in data.items() if k not in _HASH_VOLATILE_FIELDS}
+    blob = json.dumps(stable, sort_keys=True, separators=(",", ":"),
+                      default=lambda v: getattr(v, "path", None) or repr(v))
+    return blake2b(blob.encode("utf-8"), digest_size=8).hexdigest()
+
+def fetch_dst_hashes(collection: str, doc_ids, chunk_size: int = 300):
+    """Bulk-read _migration_hash of existing DST docs -> {doc_id: hash}."""
+    col = DST_DB.collection(collection)
+    doc_ids = list(doc_ids)
+    hashes = {}
+    for i in range(0, len(doc_ids), chunk_size):
+        refs = [col.document(x) for x in doc_ids[i:i + chunk_size]]
+        for snap in DST_DB.get_all(refs, field_paths=["_migration_hash"]):
+            if snap.exists:
+                h = (snap.to_dict() or {}).get("_migration_hash")
+                if h:
+                    hashes[snap.id] = h
+    return hashes
+
+def new_bulk_writer(counter_key: str = None, done_ids: list = None, failed_ids: list = None):
+    """
+    Parallel BulkWriter for DST that counts successful writes (and collects their ids,
+    and the ids of writes that failed for good).
+    """
+    bw = DST_DB.bulk_writer(options=BulkWriterOptions(mode=SendMode.parallel))
+
+    def on_result(reference, result, writer):
+        if counter_key:
+            with _counters_lock:
+                COUNTERS[counter_key] += 1
+        if done_ids is not None:
+            done_ids.append(reference.id)
+
+    def on_error(failure, writer) -> bool:
+        retry = failure.attempts < BULK_MAX_ATTEMPTS
+        if not retry:
+            print(f"[ERROR] Write failed for {failure.operation.reference.path}: {failure.message}")
+            if failed_ids is not None:
+                failed_ids.append(failure.operation.reference.id)
+        return retry
+
+    bw.on_write_result(on_result)
+    bw.on_write_error(on_error)
+    return bw
+
+def get_all_chunked(client: Client, refs, field_paths=None, chunk_size: int = 100):
+    """client.get_all() over refs in chunks issued concurrently; yields snapshots (unordered)."""
+    refs = list(refs)
+    chunks = [refs[i:i + chunk_size] for i in range(0, len(refs), chunk_size)]
+    if len(chunks) <= 1:
+        for chunk in chunks:
+            yield from client.get_all(chunk, field_paths=field_paths)
+        return
+    futures = [_lookup_pool.submit(lambda c: list(client.get_all(c, field_paths=field_paths)), chunk)
+               for chunk in chunks]
+    for fut in as_completed(futures):
+        yield from fut.result()
+
+def prefetch_link_info(link_ids):
+    """
+    Bulk-resolve link_id -> (link_data, owner_id, campaign_code) for hits.
+    Prefers migrated DST links; otherwise SRC links plus their SRC campaign.
+    """
+    info = {}
+    link_ids = list(link_ids)
+    if PREFER_DST_LINK_LOOKUP:
+        dst_col = DST_DB.collection(LINKS_DST)
+        for snap in get_all_chunked(DST_DB, (dst_col.document(x) for x in link_ids),
+                                    ["owner_id", "campaign_code", "business_ref"]):
+            link_data = (snap.to_dict() or {}) if snap.exists else {}
+            if link_data:
+                # campaign_code is the convenience field we added on links
+                info[snap.id] = (link_data, link_data.get("owner_id"), link_data.get("campaign_code"))
+
+    missing = [x for x in link_ids if x not in info]
+    if not missing:
+        return info
+
+    src_col = SRC_DB.collection(LINKS_SRC)
+    src_links = {}
+    for snap in get_all_chunked(SRC_DB, (src_col.document(x) for x in missing),
+                                ["campaign_ref", "business_ref"]):
+        if snap.exists:
+            src_links[snap.id] = snap.to_dict() or {}
+
+    # Read SRC campaigns referenced by those links to get code/owner
+    camp_refs = {ld["campaign_ref"].path: ld["campaign_ref"]
+                 for ld in src_links.values() if ld.get("campaign_ref")}
+    camps = {}
+    try:
+        for snap in get_all_chunked(SRC_DB, camp_refs.values(), ["owner_id", "code", "name"]):
+            if snap.exists:
+                camps[snap.reference.path] = snap.to_dict() or {}
+    except Exception as e:
+        print(f"[WARN] Could not read SRC campaigns for {len(camp_refs)} links: {e}")
+
+    for link_id, link_data in src_links.items():
+        camp_ref = link_data.get("campaign_ref")
+        camp_data = camps.get(camp_ref.path, {}) if camp_ref else {}
+        info[link_id] = (link_data, camp_data.get("owner_id"),
+                         camp_data.get("code") or camp_data.get("name"))
+    return info
+
+def iter_hits_prefetched(snaps, link_info: dict, lookahead: int = HIT_LOOKAHEAD):
+    """
+    Yield (hit_id, hit_data) from a snapshot stream, bulk-prefetching the links of
+    each look-ahead window into link_info before its hits are handed out.
+    """
+    snaps = iter(snaps)
+    while True:
+        # Convert each snapshot once; to_dict() deep-copies the document
+        window = [(snap.id, snap.to_dict() or {}) for snap in islice(snaps, lookahead)]
+        if not window:
+            return
+        new_ids = {d["link_id"] for _, d in window if d.get("link_id") and d["link_id"] not in link_info}
+        if new_ids:
+            link_info.update(prefetch_link_info(new_ids))
+            for link_id in new_ids:
+                link_info.setdefault(link_id, (None, None, None))   # don't refetch misses
+        yield from window
+
+class IpHashSketch:
+    """Set-like (add / |= / len) approximate distinct counter for ip hashes."""
+    __slots__ = ("hll",)
+
+    def __init__(self):
+        from datasketch import HyperLogLogPlusPlus   # optional; only with UNIQUE_IPS_SKETCH
+        self.hll = HyperLogLogPlusPlus(p=14)
+
+    def add(self, ip_hash: str):
+        self.hll.update(ip_hash.encode("utf-8"))
+
+    def __ior__(self, other):
+        self.hll.merge(other.hll)
+        return self
+
+    def __len__(self):
+        return int(round(self.hll.count()))
+
+def new_campaign_aggregates():
+    """Per-campaign aggregates as parallel maps: (links, hits, targets, iphashes)."""
+    return Counter(), Counter(), defaultdict(set), defaultdict(IpHashSketch if UNIQUE_IPS_SKETCH else set)
+
+def merge_campaign_aggregates(*parts):
+    """Combine aggregates collected by independent phases."""
+    links_ctr, hits_ctr, targets_map, ips_map = new_campaign_aggregates()
+    for p_links, p_hits, p_targets, p_ips in parts:
+        links_ctr.update(p_links); hits_ctr.update(p_hits)
+        for cid, ids in p_targets.items(): targets_map[cid] |= ids
+        for cid, ips in p_ips.items(): ips_map[cid] |= ips
+    return links_ctr, hits_ctr, targets_map, ips_map
+
+def build_by_campaign(aggs):
+    """Fold the parallel maps into {campaign_id: {links, targets, hits, iphashes}}."""
+    links_ctr, hits_ctr, targets_map, ips_map = aggs
+    keys = set(links_ctr) | set(hits_ctr) | set(targets_map)
+    return {
+        cid: {"links": links_ctr[cid], "targets": targets_map.get(cid, set()),
+              "hits": hits_ctr[cid], "iphashes": ips_map.get(cid) or set()}
+        for cid in keys
+    }
+
 def coalesce_timestamp(ts):
     return ts if ts is not None else firestore.SERVER_TIMESTAMP
 
 # =====================
 # Migration: Links (SRC -> DST)
 # =====================
-def migrate_links():
+def migrate_links(aggs):
     print("Scanning old links (SRC default DB) ...")
     q = SRC_DB.collection(LINKS_SRC)
-    if FILTER_CAMPAIGN_CODE:
-        q = q.where("campaign", "==", FILTER_CAMPAIGN_CODE)
-    old_links = list(q.stream())
+    q = campaign_filter(q)
+    q = resume_query(q, LINKS_SRC)
     if LINK_LIMIT and LINK_LIMIT > 0:
+        q = q.limit(LINK_LIMIT + 1)   # one extra doc tells whether the pass was cut short
+    old_links = list(q.stream())
+    truncated = bool(LINK_LIMIT and LINK_LIMIT > 0 and len(old_links) > LINK_LIMIT)
+    if truncated:
         old_links = old_links[:LINK_LIMIT]
+    # Link doc ids must stay == short_code (redirector looks them up directly), so
+    # instead of renaming docs we write them in shard order to avoid a hot tablet.
+    old_links.sort(key=lambda s: write_order_key(s.id))
 
     COUNTERS["links_scanned"] = len(old_links)
     print(f"Found {len(old_links)} links (after filters/limits)")
 
+    # Existing DST payload hashes so unchanged links are not re-written on re-runs
+    dst_hashes = fetch_dst_hashes(LINKS_DST, (s.id for s in old_links))
+
     now_ts = datetime.now(timezone.utc)
     batch = DST_DB.batch(); ops = 0
-    by_campaign = {}
+    links_ctr, _, targets_map, _ = aggs
     printed = 0
 
-    for s in tqdm(old_links, desc="Migrating links", unit="link"):
+    for s in progress(old_links, "Migrating links", "link"):
         d = s.to_dict() or {}
         campaign_code = d.get("campaign")                # may be None in SRC new schema
         customer_code = d.get("customer")                # fallback owner mapping
@@ -241,8 +671,12 @@ def migrate_links():
             "updated_at": now_ts,
             "campaign_code": campaign_code,           # convenience for later lookups
         }
+        data["_migration_hash"] = payload_hash(data)
+        unchanged = dst_hashes.get(short_code) == data["_migration_hash"]
 
-        if DRY_RUN:
+        if unchanged:
+            COUNTERS["links_unchanged"] += 1
+        elif DRY_RUN:
             if printed < PRINT_LIMIT_LINKS:
                 print(f"DRY RUN: would set link {short_code} (DST) -> {data}")
                 COUNTERS["links_printed"] += 1; printed += 1
@@ -256,159 +690,198 @@ def migrate_links():
 
         # Totals
         key = campaign_ref.id
-        agg = by_campaign.setdefault(key, {"links": 0, "targets": set(), "hits": 0, "iphashes": set()})
-        agg["links"] += 1; agg["targets"].add(target_ref.id)
+        links_ctr[key] += 1; targets_map[key].add(target_ref.id)
 
         if ops >= 400 and not DRY_RUN:
             batch.commit(); batch = DST_DB.batch(); ops = 0
 
     if ops and not DRY_RUN:
         batch.commit()
+    # Writes are not in id order, so only checkpoint once the whole pass is committed (a
+    # failed commit raises before this point). Every scanned id is marked, including links
+    # skipped with a warning, so a window of unresolvable links cannot pin the cursor.
+    # A pass that reached the end of the stream needs no checkpoint at all.
+    if truncated:
+        checkpoint_mark(LINKS_SRC, [s.id for s in old_links])
+    else:
+        checkpoint_clear(LINKS_SRC)
 
-    return by_campaign
+    return aggs
 
 # =====================
 # Migration: Hits (SRC -> DST; uses DST links if available)
 # =====================
-def migrate_hits(by_campaign):
+def process_hit(hit_id: str, d: dict, link_info: dict, now_ts):
+    """
+    Resolve owner/campaign/target for one SRC hit (runs on a worker thread).
+    Returns (new_hit_ref, data, campaign_id, target_id) or None when the hit is skipped.
+    """
+    d_get = d.get
+    business_id    = d_get("business_id")
+    campaign_code  = d_get("campaign")  # may be None in SRC new schema
+    link_id        = d_get("link_id")
+    template_id    = d_get("template")
+
+    # Link lookups were bulk-prefetched (DST first, SRC fallback)
+    link_data, owner_id, campaign_code_from_link = link_info.get(link_id, (None, None, None))
+
+    # Finalize owner_id
+    if not owner_id:
+        cust = (campaign_code or "").split("-")[0] if campaign_code else None
+        owner_id = CUSTOMER_OWNER_MAP.get(cust)
+    if not owner_id:
+        logger.warning("[WARN] Skip hit %s: cannot resolve owner_id", hit_id)
+        return None
+
+    # Decide campaign_code to use
+    campaign_code_effective = campaign_code or campaign_code_from_link
+    if not campaign_code_effective:
+        logger.warning("[WARN] Skip hit %s: missing campaign code (hit+link)", hit_id)
+        return None
+
+    # IMPORTANT: always ensure DST campaign_ref from code+owner
+    campaign_ref, _ = ensure_campaign(owner_id, campaign_code_effective, now_ts)
+
+    # Backfill business_id from link data if needed
+    if not business_id and link_data:
+        bref_from_link = link_data.get("business_ref")  # may be DST or SRC doc ref
+        if bref_from_link:
+            business_id = bref_from_link.id
+
+    if not business_id:
+        logger.warning("[WARN] Skip hit %s: missing business_id (even after link lookup)", hit_id)
+        return None
+
+    target_ref, _ = ensure_target(campaign_ref, business_id, now_ts)
+    bref_dst = dst_business_ref(business_id)
+
+    new_hit_ref = _dst_hits_col.document(hit_id)
+    data = {
+        "business_ref": bref_dst,
+        "campaign_ref": campaign_ref,      # DST ref
+        "target_ref": target_ref,          # DST ref
+        "owner_id": owner_id,
+        "template_id": template_id,
+        "link_id": link_id,
+        "ts": d_get("ts") or now_ts,
+        **{k: d_get(k) for k in HIT_PASSTHROUGH},
+        "updated_at": firestore.SERVER_TIMESTAMP,
+    }
+
+    return new_hit_ref, data, campaign_ref.id, target_ref.id
+
+def migrate_hits(aggs):
     print("Scanning old hits (SRC default DB) ...")
-    q = SRC_DB.collection(HITS_SRC)
-    if FILTER_CAMPAIGN_CODE:
-        q = q.where("campaign", "==", FILTER_CAMPAIGN_CODE)
-    old_hits = list(q.stream())
+    q = SRC_DB.collection(HITS_SRC).select(list(HIT_SRC_FIELDS))
+    q = campaign_filter(q)
+    q = resume_query(q, HITS_SRC)
+    hit_iter = q.stream()
     if HIT_LIMIT and HIT_LIMIT > 0:
-        old_hits = old_hits[:HIT_LIMIT]
+        hit_iter = islice(hit_iter, HIT_LIMIT)
 
-    COUNTERS["hits_scanned"] = len(old_hits)
-    print(f"Found {len(old_hits)} hits (after filters/limits)")
+    # link_id -> (link_data, owner_id, campaign_code), filled one look-ahead window at a time
+    link_info = {}
+    scanned = 0
 
     now_ts = datetime.now(timezone.utc)
-    batch = DST_DB.batch(); ops = 0; printed = 0
-
-    for s in tqdm(old_hits, desc="Migrating hits", unit="hit"):
-        d = s.to_dict() or {}
-        business_id    = d.get("business_id")
-        campaign_code  = d.get("campaign")  # may be None in SRC new schema
-        link_id        = d.get("link_id")
-        template_id    = d.get("template")
-
-        owner_id = None
-        link_data = None
-        campaign_code_from_link = None
-
-        # Prefer link lookup from DST (if links were migrated), fall back to SRC
-        if link_id:
-            if PREFER_DST_LINK_LOOKUP:
-                link_snap = DST_DB.collection(LINKS_DST).document(link_id).get()
-                if link_snap.exists:
-                    link_data = link_snap.to_dict() or {}
-                    owner_id = link_data.get("owner_id")
-                    # convenience field we added on links:
-                    campaign_code_from_link = link_data.get("campaign_code") or campaign_code_from_link
-
-            if not link_data:
-                link_snap_src = SRC_DB.collection(LINKS_SRC).document(link_id).get()
-                if link_snap_src.exists:
-                    link_data = link_snap_src.to_dict() or {}
-                    # Try to read SRC campaign_ref to get code/owner
-                    camp_ref_src = link_data.get("campaign_ref")
-                    if camp_ref_src:
-                        try:
-                            camp_snap = camp_ref_src.get()
-                            if camp_snap.exists:
-                                camp_data = camp_snap.to_dict() or {}
-                                campaign_code_from_link = campaign_code_from_link or camp_data.get("code") or camp_data.get("name")
-                                owner_id = owner_id or camp_data.get("owner_id")
-                        except Exception as e:
-                            print(f"[WARN] Could not read SRC campaign via link {link_id}: {e}")
-
-        # Finalize owner_id
-        if not owner_id:
-            cust = (campaign_code or "").split("-")[0] if campaign_code else None
-            owner_id = CUSTOMER_OWNER_MAP.get(cust)
-        if not owner_id:
-            print(f"[WARN] Skip hit {s.id}: cannot resolve owner_id")
-            continue
-
-        # Decide campaign_code to use
-        campaign_code_effective = campaign_code or campaign_code_from_link
-        if not campaign_code_effective:
-            print(f"[WARN] Skip hit {s.id}: missing campaign code (hit+link)")
-            continue
-
-        # IMPORTANT: always ensure DST campaign_ref from code+owner
-        campaign_ref, _ = ensure_campaign(owner_id, campaign_code_effective, now_ts)
-
-        # Backfill business_id from link data if needed
-        if not business_id and link_data:
-            bref_from_link = link_data.get("business_ref")  # may be DST or SRC doc ref
-            if bref_from_link:
-                business_id = bref_from_link.id
-
-        if not business_id:
-            print(f"[WARN] Skip hit {s.id}: missing business_id (even after link lookup)")
-            continue
-
-        target_ref, _ = ensure_target(campaign_ref, business_id, now_ts)
-        bref_dst = dst_business_ref(business_id)
-
-        new_hit_ref = DST_DB.collection(HITS_DST).document(s.id)
-        data = {
-            "business_ref": bref_dst,
-            "campaign_ref": campaign_ref,      # DST ref
-            "target_ref": target_ref,          # DST ref
-            "owner_id": owner_id,
-            "template_id": template_id,
-            "link_id": link_id,
-            "ts": d.get("ts") or now_ts,
-            "device_type": d.get("device_type"),
-            "geo_city": d.get("geo_city"),
-            "geo_country": d.get("geo_country"),
-            "geo_lat": d.get("geo_lat"),
-            "geo_lon": d.get("geo_lon"),
-            "geo_region": d.get("geo_region"),
-            "geo_source": d.get("geo_source"),
-            "ip_hash": d.get("ip_hash"),
-            "ua_browser": d.get("ua_browser"),
-            "ua_os": d.get("ua_os"),
-            "user_agent": d.get("user_agent"),
-            "updated_at": now_ts,
-        }
-
-        if DRY_RUN:
-            if printed < PRINT_LIMIT_HITS:
-                print(f"DRY RUN: would set hit {s.id} (DST) -> {data}")
-                COUNTERS["hits_printed"] += 1; printed += 1
-            elif printed == PRINT_LIMIT_HITS:
-                print("... further hits suppressed ...")
-                COUNTERS["hits_suppressed"] += (len(old_hits) - PRINT_LIMIT_HITS)
-                printed += 1
-        else:
-            batch.set(new_hit_ref, data, merge=True)
-            ops += 1; COUNTERS["hits_migrated"] += 1
-
-        # Totals
-        key = campaign_ref.id
-        agg = by_campaign.setdefault(key, {"links": 0, "targets": set(), "hits": 0, "iphashes": set()})
-        agg["hits"] += 1
-        if d.get("ip_hash"): agg["iphashes"].add(d["ip_hash"])
-        agg["targets"].add(target_ref.id)
-
-        if ops >= 400 and not DRY_RUN:
-            batch.commit(); batch = DST_DB.batch(); ops = 0
-
-    if ops and not DRY_RUN:
-        batch.commit()
-
-    return by_campaign
+    done_ids = []; failed_ids = []
+    bw = None if DRY_RUN else new_bulk_writer("hits_migrated", done_ids, failed_ids)
+    ops = 0; printed = 0
+    _, hits_ctr, targets_map, ips_map = aggs
+    # Hit-derived totals are flushed periodically so a crash still leaves them current.
+    # Skipped on resumed runs, whose aggregates only cover the delta.
+    flush_totals = not DRY_RUN and HITS_SRC not in _resumed_collections
+    totals_bw = new_bulk_writer() if flush_totals else None
+    dirty_campaigns = set(); since_totals = 0
+
+    hits = progress(iter_hits_prefetched(hit_iter, link_info), "Migrating hits", "hit")
+
+    def resolve(hit):
+        return process_hit(hit[0], hit[1], link_info, now_ts)
+
+    with ThreadPoolExecutor(max_workers=HIT_WORKERS) as pool:
+        while True:
+            window = list(islice(hits, HIT_LOOKAHEAD))
+            if not window:
+                break
+            scanned += len(window)
+            # Resolve in parallel; map() keeps SRC order so writes are enqueued deterministically
+            for hit_id, result in zip((h[0] for h in window), pool.map(resolve, window)):
+                if result is None:
+                    # Unresolvable hits count as processed so they cannot pin the cursor
+                    if not DRY_RUN:
+                        done_ids.append(hit_id)
+                    continue
+                new_hit_ref, data, key, target_id = result
+
+                if DRY_RUN:
+                    if printed < PRINT_LIMIT_HITS:
+                        logger.info("DRY RUN: would set hit %s (DST) -> %s", hit_id, data)
+                        COUNTERS["hits_printed"] += 1; printed += 1
+                    else:
+                        if printed == PRINT_LIMIT_HITS:
+                            logger.info("... further hits suppressed ...")
+                            printed += 1
+                        COUNTERS["hits_suppressed"] += 1
+                else:
+                    # Hits are fully re-emitted on every run, so a plain overwrite is enough
+                    # (no merge); re-runs stay idempotent.
+                    bw.set(new_hit_ref, data)
+                    ops += 1
+
+                # Totals
+                hits_ctr[key] += 1
+                targets_map[key].add(target_id)
+                ip_hash = data["ip_hash"]
+                if ip_hash: ips_map[key].add(ip_hash)
+                dirty_campaigns.add(key); since_totals += 1
+
+                if flush_totals and since_totals >= TOTALS_FLUSH_EVERY:
+                    flush_hit_totals(totals_bw, dirty_campaigns, aggs)
+                    dirty_campaigns.clear(); since_totals = 0
+
+                if ops >= BULK_FLUSH_EVERY:
+                    bw.flush(); ops = 0
+                    checkpoint_mark(HITS_SRC, done_ids, failed_ids); done_ids.clear(); failed_ids.clear()
+
+    if bw:
+        bw.close()
+        checkpoint_mark(HITS_SRC, done_ids, failed_ids); done_ids.clear(); failed_ids.clear()
+        if not (HIT_LIMIT and HIT_LIMIT > 0 and scanned >= HIT_LIMIT):
+            checkpoint_clear(HITS_SRC)   # no-op if a write failed
+    if totals_bw:
+        flush_hit_totals(totals_bw, dirty_campaigns, aggs)
+        totals_bw.close()
+
+    _log_buffer.flush()
+    COUNTERS["hits_scanned"] = scanned
+    print(f"Scanned {scanned} hits (after filters/limits)")
+
+    return aggs
 
 # =====================
 # Totals + Summary (DST)
 # =====================
+def flush_hit_totals(bw, campaign_ids, aggs):
+    """Merge hit-derived totals (hits, unique_ips) of the given campaigns into DST."""
+    _, hits_ctr, _, ips_map = aggs
+    now_ts = datetime.now(timezone.utc)
+    for campaign_id in campaign_ids:
+        cref = DST_DB.collection(CAMPAIGNS_DST).document(campaign_id)
+        totals = {"hits": hits_ctr[campaign_id], "unique_ips": len(ips_map.get(campaign_id) or ())}
+        bw.set(cref, {"totals": totals, "updated_at": now_ts}, merge=True)
+
 def recompute_campaign_totals(by_campaign):
+    """Final totals write; links/targets span both phases, so they are only known here."""
     print("Updating campaign totals (DST) ...")
+    if _resumed_collections:
+        # Aggregates only cover docs streamed in this run; overwriting would undercount.
+        print(f"[WARN] Incremental run ({', '.join(sorted(_resumed_collections))}); "
+              "skipping totals. Checkpoints are cleared once a pass completes cleanly, so the "
+              "next run rebuilds them; set RESET_CHECKPOINT = True to force a full run now.")
+        return
     now_ts = datetime.now(timezone.utc)
-    batch = DST_DB.batch(); ops = 0
+    bw = None if DRY_RUN else new_bulk_writer()
     for campaign_id, agg in by_campaign.items():
         cref = DST_DB.collection(CAMPAIGNS_DST).document(campaign_id)
         totals = {
@@ -420,12 +893,19 @@ def recompute_campaign_totals(by_campaign):
         if DRY_RUN:
             print(f"DRY RUN: would update campaign {campaign_id} totals -> {totals}")
         else:
-            batch.set(cref, {"totals": totals, "updated_at": now_ts}, merge=True)
-            ops += 1
-        if ops >= 400 and not DRY_RUN:
-            batch.commit(); batch = DST_DB.batch(); ops = 0
-    if ops and not DRY_RUN:
-        batch.commit()
+            bw.set(cref, {"totals": totals, "updated_at": now_ts}, merge=True)
+    if bw:
+        bw.close()
+
+def campaign_summary_frame(by_campaign) -> pd.DataFrame:
+    """Per-campaign aggregates as a DataFrame, busiest campaigns first."""
+    df = pd.DataFrame(
+        [(cid, agg["links"], agg["hits"], agg["targets"], agg["iphashes"]) for cid, agg in by_campaign.items()],
+        columns=["campaign", "links", "hits", "targets", "unique_ips"],
+    )
+    df["targets"] = df["targets"].map(len)
+    df["unique_ips"] = df["unique_ips"].map(len)
+    return df.sort_values(["hits", "links"], ascending=False, kind="stable")
 
 def print_summary(by_campaign):
     print("\n================ MIGRATION SUMMARY ================")
@@ -447,19 +927,35 @@ def print_summary(by_campaign):
     if not DRY_RUN:
         print("\nWrites performed to DST:")
         print(f"  Links migrated: {COUNTERS['links_migrated']}")
+        print(f"  Links unchanged (skipped): {COUNTERS['links_unchanged']}")
         print(f"  Hits migrated:  {COUNTERS['hits_migrated']}")
     print("\nPer-campaign aggregates (computed during pass):")
-    for cid, agg in by_campaign.items():
-        print(f"  Campaign {cid}: links={agg.get('links',0)}, hits={agg.get('hits',0)}, "
-              f"targets={len(agg.get('targets',[]))}, unique_ips={len(agg.get('iphashes',[]))}")
+    df = campaign_summary_frame(by_campaign)
+    print(df.to_string(index=False) if not df.empty else "  (none)")
+    if SUMMARY_CSV_PATH and not df.empty:
+        df.to_csv(SUMMARY_CSV_PATH, index=False)
+        print(f"\nPer-campaign aggregates written to {SUMMARY_CSV_PATH}")
     print("===================================================\n")
 
 # =====================
 # Main
 # =====================
 def run():
-    by_campaign = migrate_links()
-    by_campaign = migrate_hits(by_campaign)
+    if RESET_CHECKPOINT:
+        reset_checkpoints()
+    preload_dst_campaigns()
+    links_aggs, hits_aggs = new_campaign_aggregates(), new_campaign_aggregates()
+    if PARALLEL_PHASES:
+        # Each phase fills its own aggregates; totals only run after both are done
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            phases = [pool.submit(migrate_links, links_aggs), pool.submit(migrate_hits, hits_aggs)]
+            for fut in phases:
+                fut.result()
+    else:
+        migrate_links(links_aggs)
+        migrate_hits(hits_aggs)
+    aggs = merge_campaign_aggregates(links_aggs, hits_aggs)
+    by_campaign = build_by_campaign(aggs)
     recompute_campaign_totals(by_campaign)
     print_summary(by_campaign)
 
@@ -21,6 +21,7 @@ Usage:
 import os
 import sys
 import argparse
+import functools
 import yaml
 from datetime import datetime, timezone
 from typing import Optional, Dict, Any, List
@@ -32,10 +33,12 @@ DEFAULT_PROJECT_DEV = "gb-qr-tracker-dev"
 DEFAULT_PROJECT_PROD = "gb-qr-tracker"
 MIGRATIONS_COLLECTION = "_migrations"
 MIGRATIONS_YAML = "migrations.yaml"
+LIST_FIELDS = ["migration_id", "migration_name", "status", "applied_at", "applied_by"]
 
 
+@functools.lru_cache(maxsize=1)
 def load_migrations_yaml() -> Dict[str, Any]:
-    """Load migrations from YAML file."""
+    """Load migrations from YAML file (parsed once per process)."""
     yaml_path = Path(__file__).parent.parent / MIGRATIONS_YAML
     if not yaml_path.exists():
         print(f"Warning: {MIGRATIONS_YAML} not found", file=sys.stderr)
@@ -123,10 +126,18 @@ def get_migration_status(
 
 
 def list_migrations(db: firestore.Client, environment: str) -> List[Dict[str, Any]]:
-    """List all recorded migrations for an environment."""
-    migrations_ref = db.collection(MIGRATIONS_COLLECTION)
-    query = migrations_ref.where("environment", "==", environment)
-    migrations = list(query.order_by("applied_at", direction=firestore.Query.DESCENDING).stream())
+    """
+    List all recorded migrations for an environment (only the fields shown by `list`).
+
+    Requires the composite index _migrations (environment ASC, applied_at DESC).
+    """
+    query = (
+        db.collection(MIGRATIONS_COLLECTION)
+        .where("environment", "==", environment)
+        .select(LIST_FIELDS)
+        .order_by("applied_at", direction=firestore.Query.DESCENDING)
+    )
+    migrations = list(query.stream())
     
     return [m.to_dict() for m in migrations]
 
@@ -145,9 +156,13 @@ def check_dependencies(migration_id: str, environment: str, project: str) -> boo
     db = firestore.Client(project=project)
     
     print(f"Checking dependencies for {migration_id}...")
+    # Fetch all dependency records in one round trip
+    refs = [db.collection(MIGRATIONS_COLLECTION).document(f"{dep_id}_{environment}") for dep_id in dependencies]
+    statuses = {snap.id: snap.to_dict() for snap in db.get_all(refs) if snap.exists}
+
     all_satisfied = True
     for dep_id in dependencies:
-        status = get_migration_status(db, dep_id, environment)
+        status = statuses.get(f"{dep_id}_{environment}")
         if not status or status.get("status") != "applied":
             print(f"  ❌ Dependency {dep_id} not applied in {environment}")
             all_satisfied = False
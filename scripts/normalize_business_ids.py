@@ -6,27 +6,57 @@ OPTIMIZED VERSION: Pre-loads all data and uses lookup maps for fast processing.
 
 Usage:
     python normalize_business_ids.py [--dry-run] [--project PROJECT_ID] [--database DATABASE_ID]
+                                     [--indexed-lookups]
 """
 
 import os
 import sys
 import argparse
-from typing import Dict, List, Optional, Set, Tuple
-from collections import defaultdict
+import functools
+from itertools import groupby, islice
+from operator import itemgetter
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from collections import Counter, defaultdict
 from datetime import datetime, timezone
 from google.cloud import firestore
 from google.cloud.firestore_v1 import ArrayUnion
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions, SendMode
+from google.rpc import code_pb2
+from google.api_core import retry as retries
 from tqdm import tqdm
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
 # Default configuration
 DEFAULT_PROJECT_ID = "gb-qr-tracker"
 DEFAULT_DATABASE_ID = "(default)"
 
 # Batch sizes
-BATCH_SIZE = 400  # Firestore batch limit is 500, leave some headroom
-MAX_WORKERS = 10  # Number of parallel workers for processing businesses
+BATCH_SIZE = 400  # Documents per get_all() read chunk
+BULK_MAX_ATTEMPTS = 5  # BulkWriter attempts per write before it is reported as failed
+MAX_WORKERS = 16  # Number of parallel workers for processing businesses (grouped by canonical id)
+INFLIGHT_PER_WORKER = 4  # Business groups queued per worker; more are submitted as tasks finish
+HIT_SCAN_PARTITIONS = 16  # Partition cursors the hits scan is split into
+NORMALIZE_CACHE_SIZE = 100_000  # Distinct raw ids memoized by normalize_business_id
+PRELOAD_WORKERS = 4 + HIT_SCAN_PARTITIONS  # One thread per scan / hits partition during preload
+
+REFERENCE_FIELDS = ["business_ref", "business_id"]  # Projection for links/hits/targets
+BLACKLIST_FIELDS = ["business_id", "business"]  # Projection for blacklist entries
+IN_QUERY_LIMIT = 30  # Max values in one Firestore 'in' filter
+# Overlay fields a merge recomputes instead of copying from the old overlay
+OVERLAY_MERGE_RESERVED = frozenset({"business_ref", "business_id", "hit_count", "last_hit_at", "updated_at"})
+# Per-business reference counters summed into the migration totals
+REFERENCE_COUNT_FIELDS = ("links_updated", "targets_updated", "overlays_updated", "blacklist_updated", "hits_updated")
+
+# Retry transient errors when opening collection streams
+STREAM_RETRY = retries.Retry(initial=1.0, maximum=30.0, multiplier=2.0, timeout=300.0)
+
+
+# Allow A-Z, a-z, 0-9, and German umlauts (ä, ö, ü, ß); everything else becomes a hyphen
+_NON_ALNUM = re.compile(r"[^A-Za-z0-9äöüÄÖÜß]+")
+_DASHES = re.compile(r"-{2,}")
+# IDs that sanitize_id would return unchanged (use fullmatch)
+_ALREADY_NORMAL = re.compile(r"[a-z0-9äöüß]+(?:-[a-z0-9äöüß]+)*")
 
 
 def sanitize_id(value: str) -> str:
@@ -34,172 +64,397 @@ def sanitize_id(value: str) -> str:
     if value is None:
         return ""
     v = str(value).strip()
-    # Allow A-Z, a-z, 0-9, and German umlauts (ä, ö, ü, ß)
+    # Plain ASCII letters/digits only need lowercasing
+    if v.isascii() and v.isalnum():
+        return v.lower()
+    if _ALREADY_NORMAL.fullmatch(v):
+        return v
     # Replace everything else with hyphens
-    v = re.sub(r"[^A-Za-z0-9äöüÄÖÜß]+", "-", v)
-    v = re.sub(r"-{2,}", "-", v).strip("-")
+    v = _NON_ALNUM.sub("-", v)
+    v = _DASHES.sub("-", v).strip("-")
     # Normalize to lowercase for consistency
     v = v.lower()
     return v
 
 
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
 def normalize_business_id(business_id: str) -> str:
-    """Normalize a business ID to lowercase."""
+    """
+    Normalize a business ID to lowercase (memoized; the same ids repeat across links/hits/targets).
+    All normalization goes through here, so sanitize_id itself stays uncached.
+    """
     return sanitize_id(business_id)
 
 
-def find_non_normalized_businesses(db: firestore.Client) -> List[Tuple[str, str]]:
+def is_normalized(business_id: str) -> bool:
     """
-    Find all businesses with non-normalized IDs using pagination to avoid timeouts.
-    Returns list of (old_id, normalized_id) tuples.
+    Cheap check for ids that normalize to themselves, so scans can skip
+    normalize_business_id (and keep its cache for the ids that change).
     """
-    businesses_ref = db.collection("businesses")
-    non_normalized = []
-    
-    # Use pagination to avoid query timeouts
-    query = businesses_ref.limit(1000)  # Process in batches of 1000
+    return _ALREADY_NORMAL.fullmatch(business_id) is not None
+
+
+def _iter_business_ids(db: firestore.Client) -> Iterator[str]:
+    """
+    Yield every business document id, paginated to avoid timeouts.
+    Only document ids are transferred (select([])).
+    """
+    businesses_ref = db.collection("businesses").select([])
     last_doc = None
     
-    print("  Scanning businesses for non-normalized IDs...")
     while True:
         if last_doc:
             query = businesses_ref.limit(1000).start_after(last_doc)
         else:
             query = businesses_ref.limit(1000)
         
-        batch = list(query.stream())
-        if not batch:
-            break
-        
-        for business_doc in tqdm(batch, desc="    Batch", leave=False):
-            old_id = business_doc.id
-            normalized_id = normalize_business_id(old_id)
-            
-            if old_id != normalized_id:
-                non_normalized.append((old_id, normalized_id))
+        page_count = 0
+        for business_doc in query.stream(retry=STREAM_RETRY):
+            page_count += 1
+            last_doc = business_doc
+            yield business_doc.id
         
-        if len(batch) < 1000:
+        if page_count < 1000:
             break
+
+
+def load_business_ids(db: firestore.Client) -> Set[str]:
+    """Load all business ids into a set (shared by the overlay passes)."""
+    print("  Pre-loading normalized business IDs...")
+    business_ids = set(tqdm(_iter_business_ids(db), desc="    Loading businesses", leave=False))
+    print(f"  Loaded {len(business_ids)} normalized business IDs")
+    return business_ids
+
+
+def find_non_normalized_businesses(db: firestore.Client) -> Iterator[Tuple[str, str]]:
+    """
+    Find all businesses with non-normalized IDs.
+    Yields (old_id, normalized_id) tuples.
+    """
+    print("  Scanning businesses for non-normalized IDs...")
+    for old_id in _iter_business_ids(db):
+        if is_normalized(old_id):
+            continue
+        normalized_id = normalize_business_id(old_id)
         
-        last_doc = batch[-1]
-    
-    return non_normalized
+        if old_id != normalized_id:
+            yield old_id, normalized_id
 
 
-def preload_all_references(db: firestore.Client) -> Dict:
+def prefetch_businesses(db: firestore.Client, business_ids: List[str]) -> Dict[str, Optional[dict]]:
+    """Read businesses in get_all chunks. Returns business_id -> data (None if missing)."""
+    businesses_ref = db.collection("businesses")
+    data_by_id = {}
+    for i in range(0, len(business_ids), BATCH_SIZE):
+        chunk = [businesses_ref.document(bid) for bid in business_ids[i:i + BATCH_SIZE]]
+        for snap in db.get_all(chunk):
+            data_by_id[snap.id] = (snap.to_dict() or {}) if snap.exists else None
+    return data_by_id
+
+
+def _scan_links(db: firestore.Client, progress=None) -> Tuple[Dict, List]:
     """
-    Pre-load all documents that reference businesses.
-    Returns lookup maps for fast access.
+    Scan links (with pagination to avoid timeouts).
+    progress is an optional shared tqdm bar, advanced once per page.
+    Returns (refs, with_business_id, normal_business_ids); refs is a flat list of
+    (business_id, doc_path) pairs (see _group_by_business) and with_business_id only
+    holds (doc_path, normalized_id) for business_id fields that need rewriting.
     """
-    print("Pre-loading all references...")
-    
-    # Maps: business_id -> list of document references
-    links_by_business = defaultdict(list)
-    hits_by_business = defaultdict(list)
-    targets_by_business = defaultdict(list)
-    overlays_by_business = defaultdict(list)  # (customer_id, business_id) -> doc_ref
-    blacklist_by_business = defaultdict(list)  # (customer_id, business_id) -> doc_ref
-    
-    # Documents with business_id field that needs normalization
-    links_with_business_id = []  # (doc_ref, business_id_value)
-    hits_with_business_id = []   # (doc_ref, business_id_value)
-    targets_with_business_id = []  # (doc_ref, business_id_value)
-    
-    # Load links (with pagination to avoid timeouts)
-    print("  Loading links...")
+    refs = []
+    with_business_id = []
+    normal_business_ids = 0
     links_ref = db.collection("links")
-    query = links_ref.limit(1000)
     last_doc = None
     
     while True:
         if last_doc:
-            query = links_ref.limit(1000).start_after(last_doc)
+            query = links_ref.select(REFERENCE_FIELDS).limit(1000).start_after(last_doc)
         else:
-            query = links_ref.limit(1000)
-        
-        batch = list(query.stream())
-        if not batch:
-            break
+            query = links_ref.select(REFERENCE_FIELDS).limit(1000)
         
-        for link_doc in tqdm(batch, desc="    Links batch", leave=False):
+        # Iterate the page lazily so each snapshot is dropped once its fields are extracted
+        page_count = 0
+        for link_doc in query.stream(retry=STREAM_RETRY):
+            page_count += 1
+            last_doc = link_doc
             link_data = link_doc.to_dict()
             business_ref = link_data.get("business_ref")
             if business_ref and hasattr(business_ref, "id"):
-                links_by_business[business_ref.id].append(link_doc.reference)
+                refs.append((sys.intern(business_ref.id), link_doc.reference.path))
             # Check for business_id field
             business_id_field = link_data.get("business_id")
             if business_id_field and isinstance(business_id_field, str):
-                links_with_business_id.append((link_doc.reference, business_id_field))
+                normalized_id = business_id_field if is_normalized(business_id_field) \
+                    else normalize_business_id(business_id_field)
+                if normalized_id != business_id_field:
+                    with_business_id.append((link_doc.reference.path, normalized_id))
+                else:
+                    normal_business_ids += 1
         
-        if len(batch) < 1000:
+        if progress is not None:
+            progress.update(page_count)
+        if page_count < 1000:
             break
-        
-        last_doc = batch[-1]
     
-    # Load hits
-    print("  Loading hits...")
-    for hit_doc in tqdm(db.collection("hits").stream(), desc="    Hits", leave=False):
-        hit_data = hit_doc.to_dict()
-        business_ref = hit_data.get("business_ref")
+    return refs, with_business_id, normal_business_ids
+
+
+def _owner_id(doc_ref, owner_collection: str) -> Optional[str]:
+    """Return the id of the owning document if doc_ref lives under owner_collection/{id}/..."""
+    owner = doc_ref.parent.parent
+    if owner is None or owner.parent.id != owner_collection:
+        return None
+    return owner.id
+
+
+def _scan_business_refs(query, owner_collection: Optional[str] = None,
+                        top_level: bool = False, progress=None) -> Tuple[Dict, List, int]:
+    """
+    Scan hits/targets-style docs. Returns (refs, with_business_id, normal_business_ids) like _scan_links.
+    owner_collection / top_level drop collection group matches outside the intended parent.
+    progress is an optional shared tqdm bar, advanced every 1000 documents.
+    """
+    refs = []
+    with_business_id = []
+    normal_business_ids = 0
+    scanned = 0
+    for doc in query.select(REFERENCE_FIELDS).stream(retry=STREAM_RETRY):
+        scanned += 1
+        if progress is not None and scanned % 1000 == 0:
+            progress.update(1000)
+        if owner_collection and _owner_id(doc.reference, owner_collection) is None:
+            continue
+        if top_level and doc.reference.parent.parent is not None:
+            continue
+        data = doc.to_dict()
+        business_ref = data.get("business_ref")
         if business_ref and hasattr(business_ref, "id"):
-            hits_by_business[business_ref.id].append(hit_doc.reference)
+            refs.append((sys.intern(business_ref.id), doc.reference.path))
         # Check for business_id field
-        business_id_field = hit_data.get("business_id")
+        business_id_field = data.get("business_id")
         if business_id_field and isinstance(business_id_field, str):
-            hits_with_business_id.append((hit_doc.reference, business_id_field))
+            normalized_id = business_id_field if is_normalized(business_id_field) \
+                else normalize_business_id(business_id_field)
+            if normalized_id != business_id_field:
+                with_business_id.append((doc.reference.path, normalized_id))
+            else:
+                normal_business_ids += 1
+    if progress is not None:
+        progress.update(scanned % 1000)
+    return refs, with_business_id, normal_business_ids
+
+
+def _scan_customer_overlays(db: firestore.Client) -> Dict:
+    """Scan all customer overlays (ids only) in one collection group query. Returns overlays_by_business."""
+    by_business = defaultdict(list)
+    for overlay_doc in db.collection_group("businesses").select([]).stream(retry=STREAM_RETRY):
+        # The group also matches the top-level businesses collection; keep only overlays
+        customer_id = _owner_id(overlay_doc.reference, "customers")
+        if customer_id is None:
+            continue
+        by_business[overlay_doc.id].append((sys.intern(customer_id), overlay_doc.reference))
+    return by_business
+
+
+def _scan_customer_blacklist(db: firestore.Client) -> Tuple[Dict, Dict]:
+    """Scan all customer blacklists in one collection group query. Returns (blacklist_by_business, blacklist_data_by_ref)."""
+    by_business = defaultdict(list)
+    data_by_ref = {}
+    query = db.collection_group("blacklist").select(BLACKLIST_FIELDS)
+    for blacklist_doc in query.stream(retry=STREAM_RETRY):
+        _add_blacklist_entry(blacklist_doc, by_business, data_by_ref)
+    return by_business, data_by_ref
+
+
+def _add_blacklist_entry(blacklist_doc, by_business: Dict, data_by_ref: Dict) -> None:
+    """Index a blacklist entry under its business_id / business fields (skips non-customer matches)."""
+    customer_id = _owner_id(blacklist_doc.reference, "customers")
+    if customer_id is None:
+        return
+    data = blacklist_doc.to_dict() or {}
+    data_by_ref[blacklist_doc.reference] = data
+    # Check business_id field
+    business_id = data.get("business_id")
+    if business_id:
+        by_business[business_id].append((customer_id, blacklist_doc.reference))
+    # Check business_ref field
+    business_ref = data.get("business")
+    if business_ref:
+        if hasattr(business_ref, "id"):
+            by_business[business_ref.id].append((customer_id, blacklist_doc.reference))
+
+
+def query_customer_docs(db: firestore.Client, old_ids_by_new_id: Dict[str, List[str]],
+                        max_workers: int = MAX_WORKERS) -> Dict:
+    """
+    Find the overlays and blacklist entries of the businesses being migrated with
+    business_id 'in' queries (one per canonical id group) instead of scanning every
+    customer. Requires business_id on every overlay (normalize_customer_businesses.py
+    backfills it) and collection group indexes on businesses/blacklist business_id.
+    Returns the overlays/blacklist/overlay_data/blacklist_data entries of preload_all_references.
+    """
+    businesses_ref = db.collection("businesses")
     
-    # Load targets (across all campaigns)
-    print("  Loading targets...")
-    campaigns = list(db.collection("campaigns").stream())
-    for campaign_doc in tqdm(campaigns, desc="    Campaigns", leave=False):
-        targets_ref = campaign_doc.reference.collection("targets")
-        for target_doc in targets_ref.stream():
-            target_data = target_doc.to_dict()
-            business_ref = target_data.get("business_ref")
-            if business_ref and hasattr(business_ref, "id"):
-                targets_by_business[business_ref.id].append(target_doc.reference)
-            # Check for business_id field
-            business_id_field = target_data.get("business_id")
-            if business_id_field and isinstance(business_id_field, str):
-                targets_with_business_id.append((target_doc.reference, business_id_field))
+    def fetch(business_ids):
+        overlays = []
+        for overlay_doc in (db.collection_group("businesses")
+                            .where("business_id", "in", business_ids)
+                            .stream(retry=STREAM_RETRY)):
+            # The group also matches the top-level businesses collection; keep only overlays
+            customer_id = _owner_id(overlay_doc.reference, "customers")
+            if customer_id is not None:
+                overlays.append((customer_id, overlay_doc))
+        blacklist = {}
+        business_refs = [businesses_ref.document(bid) for bid in business_ids]
+        for field, values in (("business_id", business_ids), ("business", business_refs)):
+            query = db.collection_group("blacklist").select(BLACKLIST_FIELDS).where(field, "in", values)
+            for blacklist_doc in query.stream(retry=STREAM_RETRY):
+                blacklist[blacklist_doc.reference.path] = blacklist_doc
+        return overlays, blacklist.values()
     
-    # Load customer overlays (with data pre-loaded)
-    print("  Loading customer overlays...")
-    customers = list(db.collection("customers").stream())
-    overlay_data_by_ref = {}  # overlay_ref -> overlay_data dict
-    for customer_doc in tqdm(customers, desc="    Customers", leave=False):
-        customer_id = customer_doc.id
-        businesses_ref = customer_doc.reference.collection("businesses")
-        for overlay_doc in businesses_ref.stream():
-            business_id = overlay_doc.id
-            overlay_data = overlay_doc.to_dict() or {}
-            overlay_data_by_ref[overlay_doc.reference] = overlay_data
-            overlays_by_business[business_id].append((customer_id, overlay_doc.reference))
+    chunks = []
+    for new_id, old_ids in old_ids_by_new_id.items():
+        ids = [new_id] + old_ids
+        chunks.extend(ids[i:i + IN_QUERY_LIMIT] for i in range(0, len(ids), IN_QUERY_LIMIT))
     
-    # Load blacklist entries (with data pre-loaded)
-    print("  Loading blacklist entries...")
-    blacklist_data_by_ref = {}  # blacklist_ref -> blacklist_data dict
-    for customer_doc in tqdm(customers, desc="    Blacklists", leave=False):
-        customer_id = customer_doc.id
-        blacklist_ref = customer_doc.reference.collection("blacklist")
-        for blacklist_doc in blacklist_ref.stream():
-            data = blacklist_doc.to_dict() or {}
-            blacklist_data_by_ref[blacklist_doc.reference] = data
-            # Check business_id field
-            business_id = data.get("business_id")
-            if business_id:
-                blacklist_by_business[business_id].append((customer_id, blacklist_doc.reference))
-            # Check business_ref field
-            business_ref = data.get("business")
-            if business_ref:
-                if hasattr(business_ref, "id"):
-                    blacklist_by_business[business_ref.id].append((customer_id, blacklist_doc.reference))
+    overlays_by_business = defaultdict(list)
+    overlay_data_by_path = {}
+    blacklist_by_business = defaultdict(list)
+    blacklist_data_by_ref = {}
+    seen_blacklist = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch, chunk) for chunk in chunks]
+        for future in tqdm(as_completed(futures), total=len(futures),
+                           desc="    Querying overlays/blacklist", leave=False):
+            overlays, blacklist = future.result()
+            for customer_id, overlay_doc in overlays:
+                overlays_by_business[overlay_doc.id].append((sys.intern(customer_id), overlay_doc.reference))
+                overlay_data_by_path[overlay_doc.reference.path] = overlay_doc.to_dict() or {}
+            for blacklist_doc in blacklist:
+                # An entry can match through both business_id and business
+                if blacklist_doc.reference.path not in seen_blacklist:
+                    seen_blacklist.add(blacklist_doc.reference.path)
+                    _add_blacklist_entry(blacklist_doc, blacklist_by_business, blacklist_data_by_ref)
     
-    print(f"  Loaded: {len(links_by_business)} businesses in links, "
-          f"{len(hits_by_business)} in hits, {len(targets_by_business)} in targets, "
+    print(f"  Found {sum(map(len, overlays_by_business.values()))} overlays and "
+          f"{len(blacklist_data_by_ref)} blacklist entries for {len(old_ids_by_new_id)} businesses")
+    return {
+        "overlays": overlays_by_business,
+        "blacklist": blacklist_by_business,
+        "overlay_data": overlay_data_by_path,
+        "blacklist_data": blacklist_data_by_ref,
+    }
+
+
+def _group_by_business(refs: List[Tuple[str, str]]) -> Tuple[List[str], Dict[str, Tuple[int, int]]]:
+    """
+    Sort flat (business_id, doc_path) pairs and lay them out as one contiguous path list
+    plus business_id -> (start, end) slice bounds into it. Consumes refs.
+    """
+    refs.sort(key=itemgetter(0))
+    paths = []
+    slices = {}
+    for business_id, group in groupby(refs, key=itemgetter(0)):
+        start = len(paths)
+        paths.extend(path for _, path in group)
+        slices[business_id] = (start, len(paths))
+    refs.clear()
+    return paths, slices
+
+
+def _prefetch_overlay_data(db: firestore.Client, overlays_by_business: Dict,
+                           executor: ThreadPoolExecutor) -> Dict[str, dict]:
+    """
+    Read the overlays a migration will touch: every overlay whose id is not normalized,
+    plus the same customer's normalized overlay when one exists.
+    Returns overlay_path -> overlay_data (missing documents are left out).
+    """
+    refs = []
+    for overlay_id, entries in overlays_by_business.items():
+        if is_normalized(overlay_id):
+            continue
+        normalized_id = normalize_business_id(overlay_id)
+        if overlay_id == normalized_id:
+            continue
+        normalized_customers = {customer_id for customer_id, _ in overlays_by_business.get(normalized_id, [])}
+        for customer_id, overlay_ref in entries:
+            refs.append(overlay_ref)
+            if customer_id in normalized_customers:
+                refs.append(overlay_ref.parent.document(normalized_id))
+    
+    def fetch(chunk):
+        return {snap.reference.path: snap.to_dict() or {} for snap in db.get_all(chunk) if snap.exists}
+    
+    data_by_path = {}
+    futures = [executor.submit(fetch, refs[i:i + BATCH_SIZE]) for i in range(0, len(refs), BATCH_SIZE)]
+    for future in as_completed(futures):
+        data_by_path.update(future.result())
+    return data_by_path
+
+
+def preload_all_references(db: firestore.Client, max_workers: int = PRELOAD_WORKERS,
+                           customer_docs: bool = True) -> Dict:
+    """
+    Pre-load all documents that reference businesses.
+    Subcollections are read with collection group queries, and the scans run concurrently.
+    With customer_docs=False the overlay/blacklist scans are skipped (see query_customer_docs).
+    Returns lookup maps for fast access:
+    links/hits/targets are (paths, slices): one contiguous list of document path strings
+    sorted by business and business_id -> (start, end) bounds into it (plain strings
+    instead of DocumentReference objects keep the hits map small; use db.document(path) to write);
+    overlays/blacklist map business_id -> [(customer_id, doc_ref)].
+    """
+    print("Pre-loading all references...")
+    
+    # One stream per collection / collection group (hits: per partition), each on its own thread
+    print("  Loading links, hits, targets, customer overlays and blacklist entries...")
+    # One bar for all link/hit/target scan threads (tqdm.update is thread-safe)
+    progress = tqdm(desc="    Scanning references", unit="doc", leave=False)
+    with progress, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        links_future = executor.submit(_scan_links, db, progress)
+        # hits is by far the largest collection: split it into partition cursors and
+        # stream the partitions concurrently
+        hits_futures = [
+            executor.submit(_scan_business_refs, partition.query(), None, True, progress)
+            for partition in db.collection_group("hits").get_partitions(HIT_SCAN_PARTITIONS)
+        ]
+        targets_future = executor.submit(_scan_business_refs, db.collection_group("targets"), "campaigns",
+                                         False, progress)
+        if customer_docs:
+            overlays_future = executor.submit(_scan_customer_overlays, db)
+            blacklist_future = executor.submit(_scan_customer_blacklist, db)
+        
+        links_refs, links_with_business_id, links_normal = links_future.result()
+        hits_refs = []
+        hits_with_business_id = []
+        hits_normal = 0
+        for future in as_completed(hits_futures):
+            refs, with_business_id, normal = future.result()
+            hits_refs.extend(refs)
+            hits_with_business_id.extend(with_business_id)
+            hits_normal += normal
+        targets_refs, targets_with_business_id, targets_normal = targets_future.result()
+        if customer_docs:
+            overlays_by_business = overlays_future.result()
+            blacklist_by_business, blacklist_data_by_ref = blacklist_future.result()
+            
+            # The overlay scan is id-only; read full data just for the overlays being migrated
+            overlay_data_by_path = _prefetch_overlay_data(db, overlays_by_business, executor)
+        else:
+            overlays_by_business, blacklist_by_business = {}, {}
+            overlay_data_by_path, blacklist_data_by_ref = {}, {}
+    
+    links_by_business = _group_by_business(links_refs)
+    hits_by_business = _group_by_business(hits_refs)
+    targets_by_business = _group_by_business(targets_refs)
+    del links_refs, hits_refs, targets_refs
+    
+    print(f"  Loaded: {len(links_by_business[1])} businesses in links, "
+          f"{len(hits_by_business[1])} in hits, {len(targets_by_business[1])} in targets, "
           f"{len(overlays_by_business)} in overlays, {len(blacklist_by_business)} in blacklist")
-    print(f"  Found business_id fields: {len(links_with_business_id)} in links, "
-          f"{len(hits_with_business_id)} in hits, {len(targets_with_business_id)} in targets")
+    print(f"  Found non-normalized business_id fields: {len(links_with_business_id)} in links, "
+          f"{len(hits_with_business_id)} in hits, {len(targets_with_business_id)} in targets "
+          f"({links_normal + hits_normal + targets_normal} already normalized, skipped)")
     
     return {
         "links": links_by_business,
@@ -210,11 +465,41 @@ def preload_all_references(db: firestore.Client) -> Dict:
         "links_with_business_id": links_with_business_id,
         "hits_with_business_id": hits_with_business_id,
         "targets_with_business_id": targets_with_business_id,
-        "overlay_data": overlay_data_by_ref,
+        "overlay_data": overlay_data_by_path,
         "blacklist_data": blacklist_data_by_ref,
     }
 
 
+def new_bulk_writer(db: firestore.Client, errors: List[str], failed_paths: Optional[Set[str]] = None):
+    """
+    Parallel BulkWriter that retries failed writes and records final failures in errors
+    (and their document paths in failed_paths, if given).
+    A create() whose document already exists is reported without retrying.
+    """
+    bw = db.bulk_writer(options=BulkWriterOptions(mode=SendMode.parallel))
+    
+    def on_error(failure, writer) -> bool:
+        retry = failure.attempts < BULK_MAX_ATTEMPTS and failure.code != code_pb2.ALREADY_EXISTS
+        if not retry:
+            path = failure.operation.reference.path
+            errors.append(f"Write failed for {path}: {failure.message}")
+            if failed_paths is not None:
+                failed_paths.add(path)
+        return retry
+    
+    bw.on_write_error(on_error)
+    return bw
+
+
+def _business_ref_updates(references: Dict, old_id: str) -> Iterator[Tuple[str, str]]:
+    """Yield (stat_key, doc_path) for every link, hit and target whose business_ref points at old_id."""
+    for collection in ("links", "hits", "targets"):
+        paths, slices = references[collection]
+        start, end = slices.get(old_id, (0, 0))
+        for doc_path in paths[start:end]:
+            yield f"{collection}_updated", doc_path
+
+
 def migrate_business_id_batch(
     db: firestore.Client,
     old_id: str,
@@ -224,6 +509,9 @@ def migrate_business_id_batch(
 ) -> Dict:
     """
     Migrate a single business ID using pre-loaded references.
+    references["businesses"] maps business_id -> prefetched data (None if missing) and
+    is updated in place once the canonical business is written, so callers must run
+    old ids that share a new_id sequentially.
     Returns statistics about the migration.
     """
     stats = {
@@ -236,18 +524,23 @@ def migrate_business_id_batch(
         "hits_updated": 0,
         "errors": []
     }
+    bw = None
     
     try:
         old_business_ref = db.collection("businesses").document(old_id)
         new_business_ref = db.collection("businesses").document(new_id)
         
-        old_business = old_business_ref.get()
-        if not old_business.exists:
+        businesses = references["businesses"]
+        if businesses.get(old_id) is None:
             stats["errors"].append(f"Old business {old_id} does not exist")
             return stats
         
-        old_data = old_business.to_dict() or {}
-        new_business = new_business_ref.get()
+        old_data = dict(businesses[old_id])
+        existing_new_data = businesses.get(new_id)
+        
+        # One writer per business so flush() only waits on this business's writes
+        bw = None if dry_run else new_bulk_writer(db, stats["errors"])
+        deletes = []  # old documents, deleted only after their replacements are written
         
         # Create or merge canonical business
         if not dry_run:
@@ -255,9 +548,9 @@ def migrate_business_id_batch(
             if "business_id" in old_data:
                 old_data["business_id"] = new_id
             
-            if new_business.exists:
+            if existing_new_data is not None:
                 # Merge data
-                new_data = new_business.to_dict() or {}
+                new_data = existing_new_data
                 # Merge ownerIds
                 old_owner_ids = set(old_data.get("ownerIds", []))
                 new_owner_ids = set(new_data.get("ownerIds", []))
@@ -275,57 +568,29 @@ def migrate_business_id_batch(
                 if "business_id" in merged_data:
                     merged_data["business_id"] = new_id
                 
-                new_business_ref.set(merged_data, merge=True)
+                bw.set(new_business_ref, merged_data, merge=True)
+                businesses[new_id] = merged_data
                 stats["business_merged"] = True
             else:
-                # Create new business with normalized business_id
-                new_business_ref.set(old_data)
+                # Create new business with normalized business_id (fails instead of
+                # overwriting if it appeared since the prefetch)
+                bw.create(new_business_ref, old_data)
+                businesses[new_id] = old_data
                 stats["business_created"] = True
         
-        # Update all references using pre-loaded data
-        batch = db.batch()
-        ops = 0
-        
-        # Update links
-        for link_ref in references["links"].get(old_id, []):
+        # Update all links/hits/targets references using pre-loaded data, in one dispatch loop
+        business_ref_update = {"business_ref": new_business_ref}
+        for stat_key, doc_path in _business_ref_updates(references, old_id):
             if not dry_run:
-                batch.update(link_ref, {"business_ref": new_business_ref})
-                ops += 1
-                if ops >= BATCH_SIZE:
-                    batch.commit()
-                    batch = db.batch()
-                    ops = 0
-            stats["links_updated"] += 1
+                bw.update(db.document(doc_path), business_ref_update)
+            stats[stat_key] += 1
         
-        # Update hits
-        for hit_ref in references["hits"].get(old_id, []):
-            if not dry_run:
-                batch.update(hit_ref, {"business_ref": new_business_ref})
-                ops += 1
-                if ops >= BATCH_SIZE:
-                    batch.commit()
-                    batch = db.batch()
-                    ops = 0
-            stats["hits_updated"] += 1
-        
-        # Update targets
-        for target_ref in references["targets"].get(old_id, []):
-            if not dry_run:
-                batch.update(target_ref, {"business_ref": new_business_ref})
-                ops += 1
-                if ops >= BATCH_SIZE:
-                    batch.commit()
-                    batch = db.batch()
-                    ops = 0
-            stats["targets_updated"] += 1
-        
-        # Update customer overlays (using pre-loaded data)
-        overlay_data_by_ref = references.get("overlay_data", {})
-        normalized_business_exists = references.get("normalized_businesses", set())
+        # Update customer overlays (old and existing new overlays were prefetched during preload)
+        overlay_data_by_path = references.get("overlay_data", {})
+        normalized_business_exists = references.get("normalized_businesses", frozenset())
         for customer_id, overlay_ref in references["overlays"].get(old_id, []):
             if not dry_run:
-                # Use pre-loaded data instead of individual read
-                old_data_overlay = overlay_data_by_ref.get(overlay_ref, {})
+                old_data_overlay = dict(overlay_data_by_path.get(overlay_ref.path, {}))
                 if not old_data_overlay:
                     continue
                 
@@ -333,52 +598,40 @@ def migrate_business_id_batch(
                 if "business_id" in old_data_overlay:
                     old_data_overlay["business_id"] = new_id
                 
-                # Check if new overlay exists (using pre-checked set)
-                new_overlay_ref = (
-                    db.collection("customers")
-                    .document(customer_id)
-                    .collection("businesses")
-                    .document(new_id)
-                )
-                new_id_key = f"{customer_id}:{new_id}"
-                new_overlay_exists = new_id_key in normalized_business_exists
+                # Check if new overlay exists (pre-checked set, or created for an earlier
+                # old id of the same group)
+                new_overlay_ref = overlay_ref.parent.document(new_id)
+                new_overlay_exists = ((customer_id, new_id) in normalized_business_exists
+                                      or new_overlay_ref.path in overlay_data_by_path)
                 
                 if new_overlay_exists:
-                    # Need to read new overlay for merging
-                    new_overlay = new_overlay_ref.get()
-                    if new_overlay.exists:
-                        new_data_overlay = new_overlay.to_dict() or {}
-                        merged_hit_count = max(
-                            old_data_overlay.get("hit_count", 0),
-                            new_data_overlay.get("hit_count", 0)
-                        )
-                        old_last_hit = old_data_overlay.get("last_hit_at")
-                        new_last_hit = new_data_overlay.get("last_hit_at")
-                        merged_last_hit = old_last_hit if old_last_hit else new_last_hit
-                        if old_last_hit and new_last_hit:
-                            merged_last_hit = max(old_last_hit, new_last_hit)
-                        
-                        overlay_merge_data = {
-                            "business_ref": new_business_ref,
-                            "hit_count": merged_hit_count,
-                            "last_hit_at": merged_last_hit,
-                            "updated_at": firestore.SERVER_TIMESTAMP,
-                            **{k: v for k, v in old_data_overlay.items() 
-                               if k not in ["business_ref", "hit_count", "last_hit_at", "updated_at"]}
-                        }
-                        # Ensure business_id is normalized
-                        if "business_id" in overlay_merge_data:
-                            overlay_merge_data["business_id"] = new_id
-                        
-                        new_overlay_ref.set(overlay_merge_data, merge=True)
-                        overlay_ref.delete()
+                    # Merge server-side: Maximum keeps the larger hit_count atomically (the
+                    # redirector may be incrementing it concurrently); last_hit_at is only
+                    # written when the old overlay's is newer than the preloaded one
+                    new_last_hit = overlay_data_by_path.get(new_overlay_ref.path, {}).get("last_hit_at")
+                    old_last_hit = old_data_overlay.get("last_hit_at")
+                    
+                    overlay_merge_data = {
+                        "business_ref": new_business_ref,
+                        "hit_count": firestore.Maximum(old_data_overlay.get("hit_count", 0)),
+                        "updated_at": firestore.SERVER_TIMESTAMP,
+                        **{k: v for k, v in old_data_overlay.items() 
+                           if k not in OVERLAY_MERGE_RESERVED}
+                    }
+                    if old_last_hit and (not new_last_hit or old_last_hit > new_last_hit):
+                        overlay_merge_data["last_hit_at"] = old_last_hit
+                    # Ensure business_id is normalized
+                    if "business_id" in old_data_overlay:
+                        overlay_merge_data["business_id"] = new_id
+                    
+                    bw.set(new_overlay_ref, overlay_merge_data, merge=True)
+                    deletes.append(overlay_ref)
                 else:
                     # Copy to new ID with normalized business_id
-                    new_overlay_ref.set({
-                        "business_ref": new_business_ref,
-                        **old_data_overlay
-                    })
-                    overlay_ref.delete()
+                    new_data_overlay = {**old_data_overlay, "business_ref": new_business_ref}
+                    bw.create(new_overlay_ref, new_data_overlay)
+                    overlay_data_by_path[new_overlay_ref.path] = new_data_overlay
+                    deletes.append(overlay_ref)
             stats["overlays_updated"] += 1
         
         # Update blacklist (using pre-loaded data)
@@ -401,24 +654,24 @@ def migrate_business_id_batch(
                         updates["business"] = new_business_ref
                 
                 if updates:
-                    batch.update(blacklist_ref, updates)
-                    ops += 1
-                    if ops >= BATCH_SIZE:
-                        batch.commit()
-                        batch = db.batch()
-                        ops = 0
+                    bw.update(blacklist_ref, updates)
             stats["blacklist_updated"] += 1
         
-        # Commit remaining batch operations
-        if not dry_run and ops > 0:
-            batch.commit()
-        
-        # Delete old business document (only if new one was created/merged successfully)
-        if not dry_run and (stats["business_created"] or stats["business_merged"]):
-            old_business_ref.delete()
+        if not dry_run:
+            # Replacements must land before any old document is removed
+            bw.flush()
+            if not stats["errors"]:
+                for ref in deletes:
+                    bw.delete(ref)
+                # Delete old business document (only if new one was created/merged successfully)
+                if stats["business_created"] or stats["business_merged"]:
+                    bw.delete(old_business_ref)
+            bw.close()
         
     except Exception as e:
         stats["errors"].append(str(e))
+        if bw is not None:
+            bw.close()
     
     return stats
 
@@ -430,6 +683,7 @@ def normalize_business_id_fields(
 ) -> Dict:
     """
     Normalize business_id fields in links, hits, and targets documents.
+    The preload only keeps fields that differ from their normalized form.
     Returns statistics.
     """
     stats = {
@@ -439,64 +693,48 @@ def normalize_business_id_fields(
         "errors": []
     }
     
-    batch = db.batch()
-    ops = 0
-    
-    # Normalize business_id in links
-    for link_ref, business_id_value in references.get("links_with_business_id", []):
-        normalized_id = normalize_business_id(business_id_value)
-        if business_id_value != normalized_id:
-            if not dry_run:
-                batch.update(link_ref, {"business_id": normalized_id})
-                ops += 1
-                if ops >= BATCH_SIZE:
-                    batch.commit()
-                    batch = db.batch()
-                    ops = 0
-            stats["links_updated"] += 1
-    
-    # Normalize business_id in hits
-    for hit_ref, business_id_value in references.get("hits_with_business_id", []):
-        normalized_id = normalize_business_id(business_id_value)
-        if business_id_value != normalized_id:
-            if not dry_run:
-                batch.update(hit_ref, {"business_id": normalized_id})
-                ops += 1
-                if ops >= BATCH_SIZE:
-                    batch.commit()
-                    batch = db.batch()
-                    ops = 0
-            stats["hits_updated"] += 1
-    
-    # Normalize business_id in targets
-    for target_ref, business_id_value in references.get("targets_with_business_id", []):
-        normalized_id = normalize_business_id(business_id_value)
-        if business_id_value != normalized_id:
-            if not dry_run:
-                batch.update(target_ref, {"business_id": normalized_id})
-                ops += 1
-                if ops >= BATCH_SIZE:
-                    batch.commit()
-                    batch = db.batch()
-                    ops = 0
-            stats["targets_updated"] += 1
-    
-    # Commit remaining batch operations
-    if not dry_run and ops > 0:
-        batch.commit()
+    for collection in ("links", "hits", "targets"):
+        fixes = references.get(f"{collection}_with_business_id", [])
+        # Entries are pre-filtered (path, normalized_id) pairs: dry runs only need the count
+        stats[f"{collection}_updated"] = len(fixes)
+        if dry_run:
+            continue
+        bw = new_bulk_writer(db, stats["errors"])
+        for doc_path, normalized_id in fixes:
+            bw.update(db.document(doc_path), {"business_id": normalized_id})
+        bw.close()
     
     return stats
 
 
+def _business_doc_refs(db: firestore.Client):
+    """Memoized db.collection("businesses").document: overlays of one business share the reference."""
+    return functools.lru_cache(maxsize=None)(db.collection("businesses").document)
+
+
+def _stream_customer_overlays(query) -> Iterator[Tuple[str, object]]:
+    """Yield (customer_id, overlay_doc) from a collection_group("businesses") query, skipping top-level businesses."""
+    for overlay_doc in query.stream(retry=STREAM_RETRY):
+        customer_id = _owner_id(overlay_doc.reference, "customers")
+        if customer_id is not None:
+            yield customer_id, overlay_doc
+
+
 def normalize_overlay_business_refs(
     db: firestore.Client,
-    dry_run: bool = False
+    dry_run: bool = False,
+    business_ids: Optional[Set[str]] = None,
+    overlays: Optional[List[Tuple[str, object]]] = None,
+    skip_paths: Optional[Set[str]] = None
 ) -> Dict:
     """
     Normalize business_ref fields in customer overlay documents.
     
     This function fixes cases where overlay documents have business_ref pointing
     to non-normalized business IDs, even if the overlay document ID itself is normalized.
+    business_ids is the set of existing business ids (loaded if not given); overlays is a
+    shared scan from _load_customer_overlays (streamed if not given) and overlays whose
+    path is in skip_paths are left out.
     
     Returns statistics.
     """
@@ -509,59 +747,30 @@ def normalize_overlay_business_refs(
     }
     
     # Pre-load all normalized business IDs to avoid individual .get() calls
-    print("  Pre-loading normalized business IDs...")
-    normalized_businesses = set()
-    businesses_ref = db.collection("businesses")
-    query = businesses_ref.limit(1000)
-    last_doc = None
-    
-    while True:
-        if last_doc:
-            query = businesses_ref.limit(1000).start_after(last_doc)
-        else:
-            query = businesses_ref.limit(1000)
-        
-        batch = list(query.stream())
-        if not batch:
-            break
-        
-        for business_doc in tqdm(batch, desc="    Loading businesses", leave=False):
-            normalized_businesses.add(business_doc.id)
-        
-        if len(batch) < 1000:
-            break
-        
-        last_doc = batch[-1]
-    
-    print(f"  Loaded {len(normalized_businesses)} normalized business IDs")
+    normalized_businesses = business_ids if business_ids is not None else load_business_ids(db)
     
     # Pre-load all overlay data to avoid individual .to_dict() calls
     print("  Pre-loading overlay data...")
     overlay_data_by_ref = {}  # overlay_ref -> overlay_data dict
     overlay_refs_by_customer = {}  # customer_id -> list of overlay_refs
-    customers = list(db.collection("customers").stream())
-    for customer_doc in tqdm(customers, desc="    Loading overlays", leave=False):
-        customer_id = customer_doc.id
-        businesses_ref = customer_doc.reference.collection("businesses")
-        overlay_refs = []
-        for overlay_doc in businesses_ref.stream():
-            overlay_data = overlay_doc.to_dict() or {}
-            overlay_data_by_ref[overlay_doc.reference] = overlay_data
-            overlay_refs.append(overlay_doc.reference)
-        overlay_refs_by_customer[customer_id] = overlay_refs
+    if overlays is None:
+        overlays = _stream_customer_overlays(db.collection_group("businesses").select(["business_ref"]))
+    for customer_id, overlay_doc in tqdm(overlays, desc="    Loading overlays", leave=False):
+        if skip_paths and overlay_doc.reference.path in skip_paths:
+            continue
+        overlay_data = overlay_doc.to_dict() or {}
+        overlay_data_by_ref[overlay_doc.reference] = overlay_data
+        overlay_refs_by_customer.setdefault(customer_id, []).append(overlay_doc.reference)
     
     total_overlays = len(overlay_data_by_ref)
     print(f"  Loaded {total_overlays} overlay documents")
     
-    batch = db.batch()
-    ops = 0
+    bw = None if dry_run else new_bulk_writer(db, stats["errors"])
+    business_doc_ref = _business_doc_refs(db)
     
     # Process overlays using pre-loaded data
     with tqdm(total=total_overlays, desc="Processing overlays", unit="overlay") as pbar:
-        for customer_doc in customers:
-            customer_id = customer_doc.id
-            overlay_refs = overlay_refs_by_customer.get(customer_id, [])
-            
+        for customer_id, overlay_refs in overlay_refs_by_customer.items():
             for overlay_ref in overlay_refs:
                 stats["overlays_checked"] += 1
                 # Use pre-loaded data instead of calling .to_dict()
@@ -596,36 +805,33 @@ def normalize_overlay_business_refs(
                         continue
                     
                     if not dry_run:
-                        normalized_business_ref = db.collection("businesses").document(normalized_id)
-                        batch.update(overlay_ref, {"business_ref": normalized_business_ref})
-                        ops += 1
-                        if ops >= BATCH_SIZE:
-                            batch.commit()
-                            batch = db.batch()
-                            ops = 0
+                        bw.update(overlay_ref, {"business_ref": business_doc_ref(normalized_id)})
                     
                     stats["overlays_updated"] += 1
                 
                 pbar.update(1)
     
-    # Commit remaining batch operations
-    if not dry_run and ops > 0:
-        batch.commit()
+    if not dry_run:
+        bw.close()
     
     return stats
 
 
 def normalize_overlay_document_ids(
     db: firestore.Client,
-    dry_run: bool = False
+    dry_run: bool = False,
+    business_ids: Optional[Set[str]] = None,
+    overlays: Optional[List[Tuple[str, object]]] = None
 ) -> Dict:
     """
     Normalize customer overlay document IDs to match normalized business IDs.
     
     This function ensures that overlay document IDs at /customers/{uid}/businesses/{business_id}
     are normalized and match the business_id field value in the document.
+    business_ids is the set of existing business ids (loaded if not given); overlays is a
+    shared scan from _load_customer_overlays (streamed if not given).
     
-    Returns statistics.
+    Returns statistics; touched_paths holds the overlays written or deleted.
     """
     print(f"Normalizing overlay document IDs (dry_run={dry_run})...")
     
@@ -633,84 +839,61 @@ def normalize_overlay_document_ids(
         "overlays_checked": 0,
         "overlays_renamed": 0,
         "overlays_merged": 0,
-        "errors": []
+        "errors": [],
+        "touched_paths": set(),
     }
     
     # Pre-load all normalized business IDs
-    print("  Pre-loading normalized business IDs...")
-    normalized_businesses = set()
-    businesses_ref = db.collection("businesses")
-    query = businesses_ref.limit(1000)
-    last_doc = None
+    normalized_businesses = business_ids if business_ids is not None else load_business_ids(db)
     
-    while True:
-        if last_doc:
-            query = businesses_ref.limit(1000).start_after(last_doc)
-        else:
-            query = businesses_ref.limit(1000)
-        
-        batch = list(query.stream())
-        if not batch:
-            break
-        
-        for business_doc in tqdm(batch, desc="    Loading businesses", leave=False):
-            normalized_businesses.add(business_doc.id)
-        
-        if len(batch) < 1000:
-            break
-        
-        last_doc = batch[-1]
-    
-    print(f"  Loaded {len(normalized_businesses)} normalized business IDs")
-    
-    # Pre-load all overlay data to avoid individual .to_dict() calls
+    # Pre-load overlays: ids first (select([])), then full data only for overlays whose
+    # id needs normalizing, together with any normalized overlay they could collide with
     print("  Pre-loading overlay data...")
-    overlay_data_by_ref = {}  # overlay_ref -> overlay_data dict
-    overlay_refs_list = []  # List of (customer_id, overlay_ref, old_overlay_id) tuples
-    customers = list(db.collection("customers").stream())
-    for customer_doc in tqdm(customers, desc="    Loading overlays", leave=False):
-        customer_id = customer_doc.id
-        businesses_ref = customer_doc.reference.collection("businesses")
-        for overlay_doc in businesses_ref.stream():
-            overlay_data = overlay_doc.to_dict() or {}
-            overlay_data_by_ref[overlay_doc.reference] = overlay_data
-            overlay_refs_list.append((customer_id, overlay_doc.reference, overlay_doc.id))
-    
-    total_overlays = len(overlay_refs_list)
-    print(f"  Loaded {total_overlays} overlay documents")
+    pending_overlays = {}  # overlay_path -> (customer_id, overlay_ref, overlay_id, normalized_id)
+    existing_normalized_overlays = set()  # Set of (customer_id, overlay_id) tuples
+    total_overlays = 0
+    if overlays is None:
+        overlays = _stream_customer_overlays(db.collection_group("businesses").select([]))
+    for customer_id, overlay_doc in tqdm(overlays, desc="    Loading overlays", leave=False):
+        total_overlays += 1
+        customer_id = sys.intern(customer_id)
+        overlay_id = sys.intern(overlay_doc.id)
+        existing_normalized_overlays.add((customer_id, overlay_id))
+        if is_normalized(overlay_id):
+            continue
+        normalized_id = normalize_business_id(overlay_id)
+        if overlay_id != normalized_id:
+            overlay_ref = overlay_doc.reference
+            pending_overlays[overlay_ref.path] = (customer_id, overlay_ref, overlay_id, normalized_id)
+    existing_normalized_overlays = frozenset(existing_normalized_overlays)
+    stats["overlays_checked"] = total_overlays
+    print(f"  Loaded {total_overlays} overlay documents ({len(pending_overlays)} to normalize)")
     
-    # Pre-check which normalized overlay IDs already exist (to avoid individual .get() calls)
-    print("  Pre-checking existing normalized overlay IDs...")
-    existing_normalized_overlays = set()  # Set of "customer_id:overlay_id" strings
-    for customer_doc in tqdm(customers, desc="    Checking overlays", leave=False):
-        customer_id = customer_doc.id
-        businesses_ref = customer_doc.reference.collection("businesses")
-        for overlay_doc in businesses_ref.stream():
-            overlay_id = overlay_doc.id
-            normalized_id = normalize_business_id(overlay_id)
-            # Store both original and normalized IDs
-            existing_normalized_overlays.add(f"{customer_id}:{overlay_id}")
-            if overlay_id != normalized_id:
-                existing_normalized_overlays.add(f"{customer_id}:{normalized_id}")
+    # overlay_path -> data for every pending overlay and every existing normalized overlay
+    # they map to; renames/merges below also record what they write here
+    overlay_data_by_path = {}
+    refs = [overlay_ref for _, overlay_ref, _, _ in pending_overlays.values()]
+    refs += [
+        overlay_ref.parent.document(normalized_id)
+        for customer_id, overlay_ref, _, normalized_id in pending_overlays.values()
+        if (customer_id, normalized_id) in existing_normalized_overlays
+    ]
+    for i in range(0, len(refs), BATCH_SIZE):
+        for snap in db.get_all(refs[i:i + BATCH_SIZE]):
+            if snap.exists:
+                overlay_data_by_path[snap.reference.path] = snap.to_dict() or {}
     
-    print(f"  Pre-checked {len(existing_normalized_overlays)} overlay IDs")
-    
-    batch = db.batch()
-    ops = 0
+    failed_paths = set()  # new overlays whose write failed; their old overlays are kept
+    bw = None if dry_run else new_bulk_writer(db, stats["errors"], failed_paths)
+    business_doc_ref = _business_doc_refs(db)
+    deletes = []  # (old overlay, new overlay path); old deleted once its copy is written
+    written_paths = set()  # new overlays already queued on bw in this run
     
     # Process overlays using pre-loaded data
-    with tqdm(total=total_overlays, desc="Processing overlays", unit="overlay") as pbar:
-        for customer_id, overlay_ref, old_overlay_id in overlay_refs_list:
-            stats["overlays_checked"] += 1
-            normalized_overlay_id = normalize_business_id(old_overlay_id)
-            
-            # Skip if already normalized
-            if old_overlay_id == normalized_overlay_id:
-                pbar.update(1)
-                continue
-            
+    with tqdm(total=len(pending_overlays), desc="Processing overlays", unit="overlay") as pbar:
+        for overlay_path, (customer_id, overlay_ref, old_overlay_id, normalized_overlay_id) in pending_overlays.items():
             # Use pre-loaded data
-            overlay_data = overlay_data_by_ref.get(overlay_ref, {})
+            overlay_data = overlay_data_by_path.get(overlay_path, {})
             if not overlay_data:
                 pbar.update(1)
                 continue
@@ -724,105 +907,133 @@ def normalize_overlay_document_ids(
                 pbar.update(1)
                 continue
             
-            if not dry_run:
-                # Create reference to new overlay document
-                new_overlay_ref = (
-                    db.collection("customers")
-                    .document(customer_id)
-                    .collection("businesses")
-                    .document(normalized_overlay_id)
+            # Reference to new overlay document; business_ref points to the normalized business
+            new_overlay_ref = overlay_ref.parent.document(normalized_overlay_id)
+            normalized_business_ref = business_doc_ref(normalized_overlay_id)
+            
+            # Merge if the normalized overlay exists (prefetched, or written earlier in this
+            # run by another id that normalizes to the same value); otherwise rename
+            new_overlay_data = overlay_data_by_path.get(new_overlay_ref.path)
+            
+            if new_overlay_data is not None:
+                # Merge data
+                merged_hit_count = max(
+                    overlay_data.get("hit_count", 0),
+                    new_overlay_data.get("hit_count", 0)
                 )
+                old_last_hit = overlay_data.get("last_hit_at")
+                new_last_hit = new_overlay_data.get("last_hit_at")
+                merged_last_hit = max(filter(None, (old_last_hit, new_last_hit)), default=None)
                 
-                # Check if new overlay already exists (using pre-checked set - FAST!)
-                new_id_key = f"{customer_id}:{normalized_overlay_id}"
-                new_overlay_exists = new_id_key in existing_normalized_overlays
-                
-                if new_overlay_exists:
-                    # Need to read new overlay for merging
-                    new_overlay = new_overlay_ref.get()
-                    if new_overlay.exists:
-                        # Merge data
-                        new_overlay_data = new_overlay.to_dict() or {}
-                        merged_hit_count = max(
-                            overlay_data.get("hit_count", 0),
-                            new_overlay_data.get("hit_count", 0)
-                        )
-                        old_last_hit = overlay_data.get("last_hit_at")
-                        new_last_hit = new_overlay_data.get("last_hit_at")
-                        merged_last_hit = old_last_hit if old_last_hit else new_last_hit
-                        if old_last_hit and new_last_hit:
-                            merged_last_hit = max(old_last_hit, new_last_hit)
-                        
-                        # Update business_ref to point to normalized business
-                        normalized_business_ref = db.collection("businesses").document(normalized_overlay_id)
-                        
-                        merge_data = {
-                            "business_ref": normalized_business_ref,
-                            "business_id": normalized_overlay_id,  # Ensure business_id matches document ID
-                            "hit_count": merged_hit_count,
-                            "last_hit_at": merged_last_hit,
-                            "updated_at": firestore.SERVER_TIMESTAMP,
-                            **{k: v for k, v in overlay_data.items() 
-                               if k not in ["business_ref", "business_id", "hit_count", "last_hit_at", "updated_at"]}
-                        }
-                        
-                        batch.set(new_overlay_ref, merge_data, merge=True)
-                        batch.delete(overlay_ref)
-                        ops += 2
-                        stats["overlays_merged"] += 1
-                else:
-                    # Copy to new ID with normalized business_id
-                    normalized_business_ref = db.collection("businesses").document(normalized_overlay_id)
-                    
-                    new_data = {
-                        "business_ref": normalized_business_ref,
-                        "business_id": normalized_overlay_id,  # Ensure business_id matches document ID
-                        **overlay_data
-                    }
-                    
-                    batch.set(new_overlay_ref, new_data)
-                    batch.delete(overlay_ref)
-                    ops += 2
-                    stats["overlays_renamed"] += 1
+                merge_data = {
+                    "business_ref": normalized_business_ref,
+                    "business_id": normalized_overlay_id,  # Ensure business_id matches document ID
+                    "hit_count": merged_hit_count,
+                    "last_hit_at": merged_last_hit,
+                    "updated_at": firestore.SERVER_TIMESTAMP,
+                    **{k: v for k, v in overlay_data.items() 
+                       if k not in OVERLAY_MERGE_RESERVED}
+                }
+                overlay_data_by_path[new_overlay_ref.path] = {**new_overlay_data, **merge_data}
                 
-                if ops >= BATCH_SIZE:
-                    batch.commit()
-                    batch = db.batch()
-                    ops = 0
+                if not dry_run:
+                    if new_overlay_ref.path in written_paths:
+                        # Parallel batches do not keep order for the same document
+                        bw.flush()
+                    bw.set(new_overlay_ref, merge_data, merge=True)
+                    written_paths.add(new_overlay_ref.path)
+                    deletes.append((overlay_ref, new_overlay_ref.path))
+                stats["overlays_merged"] += 1
             else:
-                # Dry run: just count what would be renamed (using pre-checked set)
-                new_id_key = f"{customer_id}:{normalized_overlay_id}"
-                new_overlay_exists = new_id_key in existing_normalized_overlays
-                if new_overlay_exists:
-                    stats["overlays_merged"] += 1
-                else:
-                    stats["overlays_renamed"] += 1
+                # Copy to new ID with normalized business_id
+                new_data = {
+                    **overlay_data,
+                    "business_ref": normalized_business_ref,
+                    "business_id": normalized_overlay_id,  # Ensure business_id matches document ID
+                }
+                overlay_data_by_path[new_overlay_ref.path] = new_data
+                
+                if not dry_run:
+                    bw.create(new_overlay_ref, new_data)
+                    written_paths.add(new_overlay_ref.path)
+                    deletes.append((overlay_ref, new_overlay_ref.path))
+                stats["overlays_renamed"] += 1
             
             pbar.update(1)
     
-    # Commit remaining batch operations
-    if not dry_run and ops > 0:
-        batch.commit()
+    if not dry_run:
+        # Copies must land before the old overlays are removed
+        bw.flush()
+        stats["touched_paths"].update(written_paths)
+        # Only skip the deletes whose replacement write failed; validation errors
+        # (e.g. a missing normalized business) never queued a copy or a delete
+        for ref, new_path in deletes:
+            if new_path in failed_paths:
+                continue
+            bw.delete(ref)
+            stats["touched_paths"].add(ref.path)
+        bw.close()
     
     return stats
 
 
+def _load_customer_overlays(db: firestore.Client) -> List[Tuple[str, object]]:
+    """Load (customer_id, overlay_doc) for every customer overlay, projected to business_ref."""
+    overlays = _stream_customer_overlays(db.collection_group("businesses").select(["business_ref"]))
+    return list(tqdm(overlays, desc="  Loading customer overlays", leave=False))
+
+
+def normalize_customer_overlays(
+    db: firestore.Client,
+    dry_run: bool = False,
+    business_ids: Optional[Set[str]] = None
+) -> Tuple[Dict, Dict]:
+    """
+    Run normalize_overlay_document_ids and then normalize_overlay_business_refs on one
+    shared overlay scan. Overlays the id pass wrote or deleted are skipped by the
+    business_ref pass; their business_ref already points to the normalized business.
+    Returns (overlay_id_stats, overlay_ref_stats).
+    """
+    if business_ids is None:
+        business_ids = load_business_ids(db)
+    overlays = _load_customer_overlays(db)
+    
+    # Normalize overlay document IDs (ensure document ID matches normalized business_id)
+    print("\nNormalizing overlay document IDs...")
+    overlay_id_stats = normalize_overlay_document_ids(db, dry_run, business_ids, overlays)
+    
+    # Normalize business_ref fields in overlays
+    print("\nNormalizing business_ref fields in overlays...")
+    overlay_ref_stats = normalize_overlay_business_refs(
+        db, dry_run, business_ids, overlays, overlay_id_stats["touched_paths"]
+    )
+    return overlay_id_stats, overlay_ref_stats
+
+
 def migrate_all_business_ids(
     db: firestore.Client,
     dry_run: bool = False,
     limit: Optional[int] = None,
-    max_workers: int = MAX_WORKERS
+    max_workers: int = MAX_WORKERS,
+    indexed_lookups: bool = False
 ) -> Dict:
     """
     Migrate all non-normalized business IDs using optimized bulk operations.
+    An interrupted run resumes by running it again: a business is only deleted once it
+    migrated without errors, so find_non_normalized_businesses no longer returns it.
+    With indexed_lookups, overlays and blacklist entries are found per business with
+    business_id queries instead of scanning every customer (see query_customer_docs).
     Returns aggregate statistics.
     """
-    print(f"Finding non-normalized business IDs (dry_run={dry_run})...")
+    # References are only complete once every scan has finished, so migration cannot start
+    # earlier; overlap the preload with the business id scan and business prefetch instead
+    preload_pool = ThreadPoolExecutor(max_workers=1)
+    references_future = preload_pool.submit(preload_all_references, db, PRELOAD_WORKERS, not indexed_lookups)
+    preload_pool.shutdown(wait=False)
     
-    non_normalized = find_non_normalized_businesses(db)
+    print(f"Finding non-normalized business IDs (dry_run={dry_run})...")
     
-    if limit:
-        non_normalized = non_normalized[:limit]
+    non_normalized = list(islice(find_non_normalized_businesses(db), limit))
     
     total = len(non_normalized)
     print(f"Found {total} non-normalized business IDs to migrate")
@@ -830,16 +1041,11 @@ def migrate_all_business_ids(
     if total == 0:
         print("All business IDs are already normalized!")
         # Still normalize business_id fields in documents
-        references = preload_all_references(db)
+        references = references_future.result()
         field_stats = normalize_business_id_fields(db, references, dry_run)
         
-        # Normalize overlay document IDs (ensure document ID matches normalized business_id)
-        print("\nNormalizing overlay document IDs...")
-        overlay_id_stats = normalize_overlay_document_ids(db, dry_run)
-        
-        # Normalize business_ref fields in overlays
-        print("\nNormalizing business_ref fields in overlays...")
-        overlay_ref_stats = normalize_overlay_business_refs(db, dry_run)
+        # Normalize overlay document IDs and business_ref fields (one shared overlay scan)
+        overlay_id_stats, overlay_ref_stats = normalize_customer_overlays(db, dry_run)
         
         return {
             "total": 0,
@@ -861,25 +1067,35 @@ def migrate_all_business_ids(
             "businesses_with_errors": 0
         }
     
-    # Pre-load all references
-    references = preload_all_references(db)
+    # Old and canonical businesses are read in get_all chunks while the preload runs
+    print("  Prefetching old and canonical businesses...")
+    business_ids = sorted({bid for pair in non_normalized for bid in pair})
+    businesses = prefetch_businesses(db, business_ids)
     
-    # Pre-check which normalized business overlays exist (for overlay merging)
-    # We need to check all possible normalized IDs that might exist
+    # Old ids that normalize to the same new id merge into one business; run them
+    # sequentially in one task so each sees the previous merge in references["businesses"]
+    old_ids_by_new_id = defaultdict(list)
+    for old_id, new_id in non_normalized:
+        old_ids_by_new_id[new_id].append(old_id)
+    
+    # Wait for the pre-loaded references
+    references = references_future.result()
+    references["businesses"] = businesses
+    if indexed_lookups:
+        print("  Querying overlays and blacklist entries by business_id...")
+        references.update(query_customer_docs(db, old_ids_by_new_id, max_workers))
+    
+    # Pre-check which overlays exist (for overlay merging), derived from the overlays already
+    # preloaded (no second customers/overlays scan). Only real overlay ids are added: adding
+    # normalized ids too would mark every overlay's own target as existing, so renames
+    # could never use create()
     print("  Pre-checking normalized business overlays...")
     normalized_businesses = set()
-    customers = list(db.collection("customers").stream())
-    for customer_doc in tqdm(customers, desc="    Checking overlays", leave=False):
-        customer_id = customer_doc.id
-        businesses_ref = customer_doc.reference.collection("businesses")
-        for overlay_doc in businesses_ref.stream():
-            # Store both the actual ID and normalized ID
-            overlay_id = overlay_doc.id
-            normalized_id = normalize_business_id(overlay_id)
-            normalized_businesses.add(f"{customer_id}:{overlay_id}")  # Original
-            if overlay_id != normalized_id:
-                normalized_businesses.add(f"{customer_id}:{normalized_id}")  # Normalized
-    references["normalized_businesses"] = normalized_businesses
+    for overlay_id, entries in references["overlays"].items():
+        overlay_id = sys.intern(overlay_id)
+        for customer_id, _ in entries:
+            normalized_businesses.add((customer_id, overlay_id))
+    references["normalized_businesses"] = frozenset(normalized_businesses)
     
     # Aggregate statistics
     aggregate_stats = {
@@ -905,38 +1121,52 @@ def migrate_all_business_ids(
     # Process businesses in parallel
     print("\nMigrating business IDs...")
     
-    def process_business(args_tuple):
-        old_id, new_id = args_tuple
-        return old_id, new_id, migrate_business_id_batch(db, old_id, new_id, references, dry_run)
+    def process_business_group(new_id, old_ids):
+        return [(old_id, new_id, migrate_business_id_batch(db, old_id, new_id, references, dry_run))
+                for old_id in old_ids]
     
+    groups = iter(old_ids_by_new_id.items())
+    reference_counts = Counter()
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(process_business, (old_id, new_id)): (old_id, new_id) 
-                   for old_id, new_id in non_normalized}
+        # Bounded submission: only a few groups per worker hold a future at any time
+        futures = {}
+        
+        def submit(count):
+            for new_id, old_ids in islice(groups, count):
+                futures[executor.submit(process_business_group, new_id, old_ids)] = (old_ids, new_id)
+        
+        submit(max_workers * INFLIGHT_PER_WORKER)
+        with tqdm(total=total, desc="Processing") as pbar:
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                submit(len(done))
+                for future in done:
+                    old_ids, new_id = futures.pop(future)
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        aggregate_stats["businesses_with_errors"] += len(old_ids)
+                        aggregate_stats["errors"].extend(
+                            f"{old_id} -> {new_id}: {str(e)}" for old_id in old_ids
+                        )
+                        pbar.update(len(old_ids))
+                        continue
+                    
+                    for old_id, new_id, stats in results:
+                        # Aggregate statistics
+                        if stats["business_created"] or stats["business_merged"]:
+                            aggregate_stats["migrated"] += 1
+                        
+                        reference_counts.update({field: stats[field] for field in REFERENCE_COUNT_FIELDS})
+                        
+                        if stats["errors"]:
+                            aggregate_stats["businesses_with_errors"] += 1
+                            aggregate_stats["errors"].extend([
+                                f"{old_id} -> {new_id}: {err}" for err in stats["errors"]
+                            ])
+                    pbar.update(len(results))
+    aggregate_stats.update(reference_counts)
         
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing"):
-            try:
-                old_id, new_id, stats = future.result()
-                
-                # Aggregate statistics
-                if stats["business_created"] or stats["business_merged"]:
-                    aggregate_stats["migrated"] += 1
-                
-                aggregate_stats["links_updated"] += stats["links_updated"]
-                aggregate_stats["targets_updated"] += stats["targets_updated"]
-                aggregate_stats["overlays_updated"] += stats["overlays_updated"]
-                aggregate_stats["blacklist_updated"] += stats["blacklist_updated"]
-                aggregate_stats["hits_updated"] += stats["hits_updated"]
-                
-                if stats["errors"]:
-                    aggregate_stats["businesses_with_errors"] += 1
-                    aggregate_stats["errors"].extend([
-                        f"{old_id} -> {new_id}: {err}" for err in stats["errors"]
-                    ])
-            except Exception as e:
-                old_id, new_id = futures[future]
-                aggregate_stats["businesses_with_errors"] += 1
-                aggregate_stats["errors"].append(f"{old_id} -> {new_id}: {str(e)}")
-    
     # Normalize business_id fields in other documents
     print("\nNormalizing business_id fields in documents...")
     field_stats = normalize_business_id_fields(db, references, dry_run)
@@ -944,18 +1174,15 @@ def migrate_all_business_ids(
     aggregate_stats["hits_business_id_updated"] = field_stats["hits_updated"]
     aggregate_stats["targets_business_id_updated"] = field_stats["targets_updated"]
     
-    # Normalize overlay document IDs (ensure document ID matches normalized business_id)
-    print("\nNormalizing overlay document IDs...")
-    overlay_id_stats = normalize_overlay_document_ids(db, dry_run)
+    # Normalize overlay document IDs and business_ref fields (one shared overlay scan,
+    # checked against the post-migration business ids)
+    overlay_id_stats, overlay_ref_stats = normalize_customer_overlays(db, dry_run)
     aggregate_stats["overlays_renamed"] = overlay_id_stats["overlays_renamed"]
     aggregate_stats["overlays_merged"] = overlay_id_stats["overlays_merged"]
     aggregate_stats["overlays_id_checked"] = overlay_id_stats["overlays_checked"]
     if overlay_id_stats["errors"]:
         aggregate_stats["errors"].extend(overlay_id_stats["errors"])
     
-    # Normalize business_ref fields in overlays
-    print("\nNormalizing business_ref fields in overlays...")
-    overlay_ref_stats = normalize_overlay_business_refs(db, dry_run)
     aggregate_stats["overlays_business_ref_updated"] = overlay_ref_stats["overlays_updated"]
     aggregate_stats["overlays_business_ref_checked"] = overlay_ref_stats["overlays_checked"]
     if overlay_ref_stats["errors"]:
@@ -1009,6 +1236,12 @@ def main():
         default=MAX_WORKERS,
         help=f"Number of parallel workers (default: {MAX_WORKERS})"
     )
+    parser.add_argument(
+        "--indexed-lookups",
+        action="store_true",
+        help="Find customer overlays/blacklist entries with business_id queries instead of scanning all "
+             "customers (requires business_id on every overlay; see normalize_customer_businesses.py)"
+    )
 
     args = parser.parse_args()
     
@@ -1024,7 +1257,9 @@ def main():
     if args.limit:
         print(f"Limit: {args.limit} businesses (testing mode)")
 
-    # Initialize Firestore client
+    # Initialize Firestore client. One client is shared by all worker threads: its gRPC
+    # channel multiplexes concurrent RPCs over HTTP/2, and the workers (MAX_WORKERS, or
+    # PRELOAD_WORKERS during the preload) stay well below the per-connection stream limit
     db = firestore.Client(project=args.project, database=args.database)
 
     # If --fix-overlay-refs-only flag is set, only run the overlay fix
@@ -1053,7 +1288,8 @@ def main():
         return 0 if len(stats["errors"]) == 0 else 1
 
     # Run migration
-    stats = migrate_all_business_ids(db, dry_run=args.dry_run, limit=args.limit, max_workers=args.workers)
+    stats = migrate_all_business_ids(db, dry_run=args.dry_run, limit=args.limit, max_workers=args.workers,
+                                     indexed_lookups=args.indexed_lookups)
 
     # Print summary
     print("\n" + "=" * 60)
@@ -2,8 +2,7 @@
 """
 Fast script to normalize customer business documents.
 
-For each customer in the customers collection:
-  - Iterate through /businesses subcollection
+All customer /businesses subcollections are read with one collection group query; per customer:
   - Normalize document IDs to lowercase
   - Ensure business_id field exists (matches documentId)
   - Ensure business_ref field is correct (/businesses/{documentId})
@@ -15,32 +14,131 @@ Usage:
 import os
 import sys
 import argparse
-from typing import Dict, List, Tuple
+import functools
+from typing import Dict, List, Optional, Tuple
+from collections import Counter, defaultdict
 from google.cloud import firestore
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions, SendMode
+from google.rpc import code_pb2
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from itertools import islice
 
 # Default configuration
 DEFAULT_PROJECT_ID = "gb-qr-tracker"
 DEFAULT_DATABASE_ID = "(default)"
 
-# Batch size for Firestore operations (max 500 per batch, use 400 for safety)
-BATCH_SIZE = 400
+# Fields needed to decide what to fix; full documents are read only for renames and their merge targets
+SCAN_FIELDS = ["business_id", "business_ref"]
+GET_ALL_CHUNK = 400  # Documents per get_all() read
+BULK_MAX_ATTEMPTS = 5  # BulkWriter attempts per write before it is reported as failed
 MAX_WORKERS = 10  # Number of parallel workers for processing customers
+INFLIGHT_PER_WORKER = 4  # Customers queued per worker; more are submitted as tasks finish
+SCAN_PARTITIONS = 8  # Collection group partitions streamed concurrently while loading
+# Fields a merge recomputes instead of copying from the renamed document
+MERGE_RESERVED = frozenset({"business_id", "business_ref", "hit_count", "last_hit_at"})
+# Per-customer counters, reported as total_<field>
+COUNT_FIELDS = ("checked", "renamed", "merged", "business_id_added", "business_ref_fixed")
 
 
 def normalize_document_id(doc_id: str) -> str:
     """Normalize document ID to lowercase."""
+    # Already-lowercase ids (the common case) are returned as is: islower() scans without
+    # allocating, and the caller's != check then short-circuits on identity
+    if doc_id.islower():
+        return doc_id
     return doc_id.lower()
 
 
+def new_bulk_writer(db: firestore.Client, errors: List[str]):
+    """
+    Parallel BulkWriter that retries failed writes and records final failures in errors.
+    A create() whose document already exists is reported without retrying.
+    """
+    bw = db.bulk_writer(options=BulkWriterOptions(mode=SendMode.parallel))
+    
+    def on_error(failure, writer) -> bool:
+        retry = failure.attempts < BULK_MAX_ATTEMPTS and failure.code != code_pb2.ALREADY_EXISTS
+        if not retry:
+            errors.append(f"Write failed for {failure.operation.reference.path}: {failure.message}")
+        return retry
+    
+    bw.on_write_error(on_error)
+    return bw
+
+
+def check_business_doc(doc_id: str, business_data: dict) -> Tuple[str, bool, bool, bool]:
+    """
+    Decide what a customer business document needs.
+    Returns (normalized_id, needs_rename, needs_business_id, needs_business_ref_fix).
+    """
+    normalized_id = normalize_document_id(doc_id)
+    needs_rename = doc_id != normalized_id
+    needs_business_id = "business_id" not in business_data
+    needs_business_ref_fix = False
+    
+    # Check business_ref
+    business_ref = business_data.get("business_ref")
+    
+    if not business_ref:
+        needs_business_ref_fix = True
+    elif hasattr(business_ref, "id"):
+        # It's a DocumentReference
+        if business_ref.id != normalized_id:
+            needs_business_ref_fix = True
+    else:
+        # Legacy string path; anything else is rewritten as a reference
+        needs_business_ref_fix = business_ref != f"/businesses/{normalized_id}"
+    
+    return normalized_id, needs_rename, needs_business_id, needs_business_ref_fix
+
+
+def load_customer_businesses(
+    db: firestore.Client,
+    partitions: int = SCAN_PARTITIONS
+) -> Dict[str, List[Tuple[firestore.DocumentReference, Optional[dict]]]]:
+    """
+    Load every customer business document with one collection group query, split into
+    partitions that are streamed concurrently. Only SCAN_FIELDS are transferred, and only
+    kept for documents that need a fix (the rest are kept as id-only entries, data None).
+    Returns customer_id -> [(business_doc_ref, business_data)].
+    """
+    def scan_partition(query):
+        found = []
+        for business_doc in query.select(SCAN_FIELDS).stream():
+            # The group also matches the top-level businesses collection; keep only customer docs
+            customer_ref = business_doc.reference.parent.parent
+            if customer_ref is None or customer_ref.parent.id != "customers":
+                continue
+            data = business_doc.to_dict() or {}
+            if not any(check_business_doc(business_doc.id, data)[1:]):
+                data = None
+            found.append((customer_ref.id, business_doc.reference, data))
+        return found
+    
+    businesses_by_customer = defaultdict(list)
+    with ThreadPoolExecutor(max_workers=partitions) as executor:
+        futures = [
+            executor.submit(scan_partition, partition.query())
+            for partition in db.collection_group("businesses").get_partitions(partitions)
+        ]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Loading customer businesses"):
+            for customer_id, business_doc_ref, data in future.result():
+                businesses_by_customer[customer_id].append((business_doc_ref, data))
+    return businesses_by_customer
+
+
 def process_customer_businesses(
     db: firestore.Client,
     customer_id: str,
-    dry_run: bool = False
+    business_docs: List[Tuple[firestore.DocumentReference, Optional[dict]]],
+    dry_run: bool = False,
+    canonical_business_ref=None
 ) -> Dict:
     """
-    Process all businesses for a single customer.
+    Process all businesses for a single customer (business_docs from load_customer_businesses).
+    canonical_business_ref builds /businesses/{id} references (shared memoized one from
+    normalize_all_customer_businesses; defaults to db.collection("businesses").document).
     Returns statistics about the processing.
     """
     stats = {
@@ -52,73 +150,61 @@ def process_customer_businesses(
         "errors": []
     }
     
+    bw = None
+    if canonical_business_ref is None:
+        canonical_business_ref = db.collection("businesses").document
     try:
-        customer_ref = db.collection("customers").document(customer_id)
-        businesses_ref = customer_ref.collection("businesses")
-        
-        # Get all business documents for this customer (with pagination for large collections)
-        business_docs = []
-        query = businesses_ref.limit(1000)
-        last_doc = None
-        
-        while True:
-            if last_doc:
-                query = businesses_ref.limit(1000).start_after(last_doc)
-            else:
-                query = businesses_ref.limit(1000)
-            
-            batch = list(query.stream())
-            if not batch:
-                break
-            
-            business_docs.extend(batch)
-            
-            if len(batch) < 1000:
-                break
-            
-            last_doc = batch[-1]
+        businesses_ref = db.collection("customers").document(customer_id).collection("businesses")
         
         stats["checked"] = len(business_docs)
         
         if not business_docs:
             return stats
         
-        # Pre-load all business document data
-        business_data_by_id = {}
-        for business_doc in business_docs:
-            business_data_by_id[business_doc.id] = business_doc.to_dict() or {}
+        # Index the pre-loaded business document data by id
+        business_data_by_id = {business_ref.id: data for business_ref, data in business_docs}
+        
+        # The scan only carries SCAN_FIELDS; renamed docs are copied and merges combine
+        # hit_count/last_hit_at, so read the full data of both in get_all chunks
+        if not dry_run:
+            full_refs = {}
+            for ref, _ in business_docs:
+                normalized_id = normalize_document_id(ref.id)
+                if normalized_id != ref.id:
+                    full_refs[ref.path] = ref
+                    if normalized_id in business_data_by_id:
+                        target_ref = businesses_ref.document(normalized_id)
+                        full_refs[target_ref.path] = target_ref
+            full_refs = list(full_refs.values())
+            for i in range(0, len(full_refs), GET_ALL_CHUNK):
+                for snap in db.get_all(full_refs[i:i + GET_ALL_CHUNK]):
+                    if snap.exists:
+                        business_data_by_id[snap.id] = snap.to_dict() or {}
         
-        batch = db.batch()
-        ops_count = 0
+        bw = None if dry_run else new_bulk_writer(db, stats["errors"])
+        deletes = []  # renamed/merged docs, deleted once their copies are written
+        written_paths = set()  # docs already queued on bw
         
-        for business_doc in business_docs:
-            old_id = business_doc.id
-            normalized_id = normalize_document_id(old_id)
+        def write(method, ref, *args, **kwargs):
+            if ref.path in written_paths:
+                # Parallel sends do not keep order for the same document
+                bw.flush()
+            method(ref, *args, **kwargs)
+            written_paths.add(ref.path)
+        
+        for business_doc_ref, _ in business_docs:
+            old_id = business_doc_ref.id
             business_data = business_data_by_id[old_id]
-            
-            needs_rename = old_id != normalized_id
-            needs_business_id = "business_id" not in business_data
-            needs_business_ref_fix = False
-            
-            # Check business_ref
-            business_ref = business_data.get("business_ref")
-            expected_business_ref = db.collection("businesses").document(normalized_id)
-            
-            if not business_ref:
-                needs_business_ref_fix = True
-            elif hasattr(business_ref, "id"):
-                # It's a DocumentReference
-                if business_ref.id != normalized_id:
-                    needs_business_ref_fix = True
-            else:
-                # It might be a string path
-                expected_path = f"/businesses/{normalized_id}"
-                if str(business_ref) != expected_path:
-                    needs_business_ref_fix = True
+            if business_data is None:
+                # Nothing to fix (decided during the scan)
+                continue
+            normalized_id, needs_rename, needs_business_id, needs_business_ref_fix = \
+                check_business_doc(old_id, business_data)
             
             # Skip if nothing needs to be done
             if not needs_rename and not needs_business_id and not needs_business_ref_fix:
                 continue
+            expected_business_ref = canonical_business_ref(normalized_id)
             
             if not dry_run:
                 if needs_rename:
@@ -128,7 +214,7 @@ def process_customer_businesses(
                     
                     if new_exists:
                         # Merge data (use pre-loaded data)
-                        new_data = business_data_by_id[normalized_id]
+                        new_data = business_data_by_id[normalized_id] or {}
                         # Merge hit_count and last_hit_at (take max)
                         merged_hit_count = max(
                             business_data.get("hit_count", 0),
@@ -136,9 +222,7 @@ def process_customer_businesses(
                         )
                         old_last_hit = business_data.get("last_hit_at")
                         new_last_hit = new_data.get("last_hit_at")
-                        merged_last_hit = old_last_hit if old_last_hit else new_last_hit
-                        if old_last_hit and new_last_hit:
-                            merged_last_hit = max(old_last_hit, new_last_hit)
+                        merged_last_hit = max(filter(None, (old_last_hit, new_last_hit)), default=None)
                         
                         # Prepare merge data
                         merge_data = {
@@ -147,23 +231,23 @@ def process_customer_businesses(
                             "hit_count": merged_hit_count,
                             "last_hit_at": merged_last_hit,
                             **{k: v for k, v in business_data.items() 
-                               if k not in ["business_id", "business_ref", "hit_count", "last_hit_at"]}
+                               if k not in MERGE_RESERVED}
                         }
                         
-                        batch.set(new_business_ref, merge_data, merge=True)
-                        batch.delete(business_doc.reference)
-                        ops_count += 2
+                        write(bw.set, new_business_ref, merge_data, merge=True)
+                        deletes.append(business_doc_ref)
                         stats["merged"] += 1
                     else:
-                        # Just rename (copy and delete)
+                        # Just rename (create the copy, then delete); later ids that
+                        # normalize to the same value merge into this copy
                         new_data = {
+                            **business_data,
                             "business_id": normalized_id,
                             "business_ref": expected_business_ref,
-                            **business_data
                         }
-                        batch.set(new_business_ref, new_data)
-                        batch.delete(business_doc.reference)
-                        ops_count += 2
+                        write(bw.create, new_business_ref, new_data)
+                        business_data_by_id[normalized_id] = new_data
+                        deletes.append(business_doc_ref)
                         stats["renamed"] += 1
                 else:
                     # No rename needed, just update fields
@@ -176,14 +260,7 @@ def process_customer_businesses(
                         stats["business_ref_fixed"] += 1
                     
                     if updates:
-                        batch.update(business_doc.reference, updates)
-                        ops_count += 1
-                
-                # Commit batch when approaching limit
-                if ops_count >= BATCH_SIZE:
-                    batch.commit()
-                    batch = db.batch()
-                    ops_count = 0
+                        write(bw.update, business_doc_ref, updates)
             else:
                 # Dry run: just count what would happen
                 if needs_rename:
@@ -197,12 +274,18 @@ def process_customer_businesses(
                 if needs_business_ref_fix:
                     stats["business_ref_fixed"] += 1
         
-        # Commit remaining operations
-        if not dry_run and ops_count > 0:
-            batch.commit()
+        if not dry_run:
+            # Delete the old docs only once every copy was written
+            bw.flush()
+            if not stats["errors"]:
+                for old_ref in deletes:
+                    bw.delete(old_ref)
+            bw.close()
     
     except Exception as e:
         stats["errors"].append(f"Customer {customer_id}: {str(e)}")
+        if bw is not None:
+            bw.close()
     
     return stats
 
@@ -218,34 +301,13 @@ def normalize_all_customer_businesses(
     """
     print(f"Starting normalization (dry_run={dry_run}, workers={max_workers})...")
     
-    # Pre-load all customer IDs (use pagination to avoid timeouts)
-    print("Pre-loading customer IDs...")
-    customers_ref = db.collection("customers")
-    customer_ids = []
+    # Pre-load all customer business documents (one collection group query instead of
+    # listing customers and streaming each subcollection)
+    print("Pre-loading customer business documents...")
+    businesses_by_customer = load_customer_businesses(db)
     
-    query = customers_ref.limit(1000)
-    last_doc = None
-    
-    while True:
-        if last_doc:
-            query = customers_ref.limit(1000).start_after(last_doc)
-        else:
-            query = customers_ref.limit(1000)
-        
-        batch = list(query.stream())
-        if not batch:
-            break
-        
-        for customer_doc in batch:
-            customer_ids.append(customer_doc.id)
-        
-        if len(batch) < 1000:
-            break
-        
-        last_doc = batch[-1]
-    
-    total_customers = len(customer_ids)
-    print(f"Found {total_customers} customers to process")
+    total_customers = len(businesses_by_customer)
+    print(f"Found {total_customers} customers with business documents to process")
     
     if total_customers == 0:
         print("No customers found!")
@@ -269,36 +331,48 @@ def normalize_all_customer_businesses(
         "errors": []
     }
     
-    # Process customers in parallel
-    def process_customer_wrapper(customer_id: str):
+    # Process customers in parallel; the same business appears under many customers,
+    # so its /businesses reference is built once and shared
+    canonical_business_ref = functools.lru_cache(maxsize=None)(db.collection("businesses").document)
+    
+    def process_customer_wrapper(customer_id: str, business_docs):
         """Wrapper for parallel processing."""
-        return customer_id, process_customer_businesses(db, customer_id, dry_run)
+        return customer_id, process_customer_businesses(db, customer_id, business_docs, dry_run, canonical_business_ref)
     
     print("Processing customers in parallel...")
+    customer_ids = iter(list(businesses_by_customer))
+    counts = Counter()
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {
-            executor.submit(process_customer_wrapper, customer_id): customer_id
-            for customer_id in customer_ids
-        }
+        # Bounded submission: only a few customers per worker are queued, and each customer's
+        # preloaded docs are released from businesses_by_customer once submitted
+        futures = {}
+        
+        def submit(count):
+            for customer_id in islice(customer_ids, count):
+                business_docs = businesses_by_customer.pop(customer_id)
+                futures[executor.submit(process_customer_wrapper, customer_id, business_docs)] = customer_id
         
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing"):
-            try:
-                customer_id, stats = future.result()
-                
-                # Aggregate statistics
-                aggregate_stats["customers_processed"] += 1
-                aggregate_stats["total_checked"] += stats["checked"]
-                aggregate_stats["total_renamed"] += stats["renamed"]
-                aggregate_stats["total_merged"] += stats["merged"]
-                aggregate_stats["total_business_id_added"] += stats["business_id_added"]
-                aggregate_stats["total_business_ref_fixed"] += stats["business_ref_fixed"]
-                
-                if stats["errors"]:
-                    aggregate_stats["errors"].extend(stats["errors"])
-            except Exception as e:
-                customer_id = futures[future]
-                aggregate_stats["errors"].append(f"Customer {customer_id}: {str(e)}")
+        submit(max_workers * INFLIGHT_PER_WORKER)
+        with tqdm(total=total_customers, desc="Processing") as pbar:
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                submit(len(done))
+                for future in done:
+                    customer_id = futures.pop(future)
+                    pbar.update(1)
+                    try:
+                        customer_id, stats = future.result()
+                        
+                        # Aggregate statistics
+                        aggregate_stats["customers_processed"] += 1
+                        counts.update({field: stats[field] for field in COUNT_FIELDS})
+                        
+                        if stats["errors"]:
+                            aggregate_stats["errors"].extend(stats["errors"])
+                    except Exception as e:
+                        aggregate_stats["errors"].append(f"Customer {customer_id}: {str(e)}")
     
+    aggregate_stats.update({f"total_{field}": counts[field] for field in COUNT_FIELDS})
     return aggregate_stats
 
 
@@ -19,10 +19,18 @@ If you have a single customer in prod, you can skip --map and just pass --fallba
 
 import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 import firebase_admin
 from firebase_admin import firestore, auth
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+# Only the fields the preview reads are fetched (select projections)
+LINK_FIELDS = ["owner_id", "customer", "business_id", "campaign", "last_hit_at"]
+HIT_FIELDS = ["owner_id", "customer", "link_id", "ts"]
+BUSINESS_FIELDS = ["ownerIds", "business_name", "name"]
+GET_USERS_BATCH = 100  # Max identifiers per auth.get_users() call
 
 
 def init_admin(project: str):
@@ -54,9 +62,33 @@ def resolve_uid(target: str) -> str | None:
 
 
 def make_label_to_uid(map_json: dict[str, str]) -> dict[str, str]:
+    # Look every target up as both uid and email in batched get_users calls; only
+    # targets the batch could not resolve fall back to resolve_uid.
+    identifiers = []
+    for tgt in set(map_json.values()):
+        if 0 < len(tgt) <= 128:
+            identifiers.append(auth.UidIdentifier(tgt))
+        if "@" in tgt:
+            try:
+                identifiers.append(auth.EmailIdentifier(tgt))
+            except ValueError:
+                pass  # Malformed email; left to resolve_uid
+
+    by_uid: dict[str, str] = {}
+    by_email: dict[str, str] = {}
+    for i in range(0, len(identifiers), GET_USERS_BATCH):
+        try:
+            result = auth.get_users(identifiers[i:i + GET_USERS_BATCH])
+        except Exception:
+            continue
+        for user in result.users:
+            by_uid[user.uid] = user.uid
+            if user.email:
+                by_email[user.email] = user.uid
+
     out: dict[str, str] = {}
     for label, tgt in map_json.items():
-        uid = resolve_uid(tgt)
+        uid = by_uid.get(tgt) or by_email.get(tgt) or resolve_uid(tgt)
         if uid:
             out[label] = uid
     return out
@@ -73,74 +105,39 @@ def to_str(v):
     return v
 
 
-def collect_link_owner_map(db) -> dict[str, str]:
+def count_missing(query, field: str) -> int:
     """
-    Build {link_id -> owner_id} for all links that already have owner_id.
-    Used to derive hits.owner_id and businesses.ownerIds in preview.
+    Server-side count of documents where `field` is missing or null.
+    Missing fields are not indexed, so this is total - count(field != null).
     """
-    m: dict[str, str] = {}
-    for d in db.collection("links").stream():
-        data = d.to_dict() or {}
-        oid = data.get("owner_id")
-        if oid:
-            m[d.id] = oid
-    return m
+    total = query.count().get()[0][0].value
+    present = query.where(filter=FieldFilter(field, "!=", None)).count().get()[0][0].value
+    return total - present
 
 
-def collect_business_owners_from_links(db) -> dict[str, set[str]]:
+def preview_links(db, args, label_to_uid: dict[str, str]):
     """
-    Build {business_id -> set(owner_ids)} from links that have both business_id and owner_id.
+    Single pass over links: samples links missing owner_id and builds the helpers used by
+    the hits/businesses previews.
+    Returns (samples, missing_owner_id_count, link_owner, biz_owners_from_links).
     """
-    m: dict[str, set[str]] = {}
-    for d in db.collection("links").stream():
-        data = d.to_dict() or {}
-        biz = data.get("business_id")
-        oid = data.get("owner_id")
-        if biz and oid:
-            m.setdefault(biz, set()).add(oid)
-    return m
-
-
-def main():
-    ap = argparse.ArgumentParser(description="Read-only JSON preview of post-migration state")
-    ap.add_argument("--project", required=True)
-    ap.add_argument("--map", help="JSON mapping {customer_label: uid_or_email}")
-    ap.add_argument("--fallback-uid", help="UID to use if mapping missing")
-    ap.add_argument("--limit", type=int, default=5, help="Max samples per collection")
-    ap.add_argument("--out", default="preview_report.json", help="Output JSON file")
-    ap.add_argument("--delete-legacy", action="store_true",
-                    help="Preview as if legacy 'customer' field would be removed")
-    args = ap.parse_args()
-
-    db = init_admin(args.project)
-
-    mapping_raw = load_mapping(args.map)
-    label_to_uid = make_label_to_uid(mapping_raw) if mapping_raw else {}
-
-    # Build helpers once
-    link_owner = collect_link_owner_map(db)  # link_id -> owner_id (existing)
-    biz_owners_from_links = collect_business_owners_from_links(db)  # business_id -> owners (from links)
-
-    # --- counts (current) ---
-    counts = {
-        "links_missing_owner_id": 0,
-        "hits_missing_owner_id": 0,
-        "businesses_without_ownerIds_array": 0
-    }
-
-    # --- preview links ---
+    link_owner: dict[str, str] = {}  # link_id -> owner_id (existing)
+    biz_owners_from_links: dict[str, set[str]] = {}  # business_id -> owners (from links)
     links_samples = []
-    for d in db.collection("links").stream():
+    missing = 0
+    for d in db.collection("links").select(LINK_FIELDS).stream():
         data = d.to_dict() or {}
-        if not data.get("owner_id"):
-            counts["links_missing_owner_id"] += 1
-
-        if len(links_samples) >= args.limit:
+        oid = data.get("owner_id")
+        if oid:
+            link_owner[d.id] = oid
+            biz = data.get("business_id")
+            if biz:
+                biz_owners_from_links.setdefault(biz, set()).add(oid)
+            # Only sample missing ones to keep report small
             continue
 
-        needs = not data.get("owner_id")
-        if not needs:
-            # Only sample missing ones to keep report small
+        missing += 1
+        if len(links_samples) >= args.limit:
             continue
 
         label = data.get("customer")
@@ -173,20 +170,68 @@ def main():
             "would_update": bool(uid)
         })
 
-    # --- preview hits ---
-    hits_samples = []
-    for d in db.collection("hits").stream():
+    return links_samples, missing, link_owner, biz_owners_from_links
+
+
+def sample_missing_owner(query, limit: int) -> list:
+    """First `limit` documents of `query` without owner_id, as (id, data) pairs."""
+    out = []
+    for d in query.stream():
+        if len(out) >= limit:
+            break
         data = d.to_dict() or {}
         if not data.get("owner_id"):
-            counts["hits_missing_owner_id"] += 1
+            out.append((d.id, data))
+    return out
 
-        if len(hits_samples) >= args.limit:
-            continue
 
-        needs = not data.get("owner_id")
-        if not needs:
-            continue
+def sample_documents(query) -> list:
+    """All documents of a (limited) query, as (id, data) pairs."""
+    return [(d.id, d.to_dict() or {}) for d in query.stream()]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Read-only JSON preview of post-migration state")
+    ap.add_argument("--project", required=True)
+    ap.add_argument("--map", help="JSON mapping {customer_label: uid_or_email}")
+    ap.add_argument("--fallback-uid", help="UID to use if mapping missing")
+    ap.add_argument("--limit", type=int, default=5, help="Max samples per collection")
+    ap.add_argument("--out", default="preview_report.json", help="Output JSON file")
+    ap.add_argument("--delete-legacy", action="store_true",
+                    help="Preview as if legacy 'customer' field would be removed")
+    args = ap.parse_args()
+
+    db = init_admin(args.project)
+
+    mapping_raw = load_mapping(args.map)
+    label_to_uid = make_label_to_uid(mapping_raw) if mapping_raw else {}
+
+    # --- counts (current) ---
+    counts = {
+        "links_missing_owner_id": 0,
+        "hits_missing_owner_id": 0,
+        "businesses_without_ownerIds_array": 0
+    }
 
+    # --- read (concurrently) ---
+    # The four reads are independent: the links pass builds the owner maps, while the hits
+    # count and the hits/businesses samples are fetched alongside it and derived afterwards
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        links_future = pool.submit(preview_links, db, args, label_to_uid)
+        hits_missing_future = pool.submit(count_missing, db.collection("hits"), "owner_id")
+        hit_docs_future = pool.submit(
+            sample_missing_owner, db.collection("hits").select(HIT_FIELDS), args.limit)
+        business_docs_future = pool.submit(
+            sample_documents, db.collection("businesses").select(BUSINESS_FIELDS).limit(args.limit))
+
+        links_samples, counts["links_missing_owner_id"], link_owner, biz_owners_from_links = links_future.result()
+        counts["hits_missing_owner_id"] = hits_missing_future.result()
+        hit_docs = hit_docs_future.result()
+        business_docs = business_docs_future.result()
+
+    # --- preview hits ---
+    hits_samples = []
+    for doc_id, data in hit_docs:
         label = data.get("customer")
         uid = None
         if label:
@@ -205,7 +250,7 @@ def main():
             del after["customer"]
 
         hits_samples.append({
-            "id": d.id,
+            "id": doc_id,
             "before": {
                 "owner_id": data.get("owner_id"),
                 "customer": data.get("customer"),
@@ -225,18 +270,15 @@ def main():
     # Sample first N businesses; derive new ownerIds as union(current, owners_from_links)
     businesses_samples = []
     sampled_biz_ids = []
-    for d in db.collection("businesses").stream():
-        if len(businesses_samples) >= args.limit:
-            break
-        sampled_biz_ids.append(d.id)
-        data = d.to_dict() or {}
+    for doc_id, data in business_docs:
+        sampled_biz_ids.append(doc_id)
         cur = data.get("ownerIds")
         if not isinstance(cur, list):
             counts["businesses_without_ownerIds_array"] += 1
-        derived = sorted(list(biz_owners_from_links.get(d.id, set())))
+        derived = sorted(list(biz_owners_from_links.get(doc_id, set())))
         union = sorted(list(set(cur or []) | set(derived)))
         businesses_samples.append({
-            "id": d.id,
+            "id": doc_id,
             "before": {
                 "ownerIds": cur,
                 "business_name": data.get("business_name") or data.get("name")
@@ -255,7 +297,7 @@ def main():
         "assumptions": {
             "delete_legacy_customer_field": args.delete_legacy,
             "fallback_uid": args.fallback_uid,
-            "mapping_labels_loaded": sorted(list((mapping_raw := load_mapping(args.map)).keys())) if args.map else [],
+            "mapping_labels_loaded": sorted(mapping_raw.keys()),
         },
         "counts_now": counts,
         "samples": {
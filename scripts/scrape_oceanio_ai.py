@@ -1,12 +1,11 @@
 import os
 import csv
-import time
 import json
 import re
 from typing import Dict, Any, Optional, Tuple, List
 from urllib.parse import urljoin
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock, Semaphore  # <-- uses Semaphore
+from threading import Semaphore  # <-- uses Semaphore
 
 import requests
 from bs4 import BeautifulSoup
@@ -297,14 +296,10 @@ def process_row(
     total_rows: int,
     imprint_text_cache: Dict[str, Optional[str]],
     domain_cache: Dict[str, Dict[str, Any]],
-    imprint_fetching: set,
-    domain_fetching: set,
-    imprint_lock: Lock,
-    domain_lock: Lock,
 ) -> Tuple[int, Dict[str, str], bool]:
     """
     Process a single row. Returns (row_idx, updated_row, was_updated).
-    Thread-safe caching is handled via locks.
+    The caches belong to the row's domain task (see process_domain), so no locking is needed.
     """
     domain = (row.get(COL_DOMAIN) or "").strip()
     company = (row.get(COL_COMPANY) or "").strip()
@@ -346,61 +341,21 @@ def process_row(
         print(f"  [{row_idx}] Nothing relevant missing → skipping GPT call.")
         return (row_idx, row, False)
 
-    # Get imprint text (cached per domain, thread-safe)
-    imprint_text = None
-    should_fetch_imprint = False
-
-    with imprint_lock:
-        if domain in imprint_text_cache:
-            imprint_text = imprint_text_cache[domain]
-        elif domain not in imprint_fetching:
-            # Mark as fetching to prevent duplicate requests
-            imprint_fetching.add(domain)
-            should_fetch_imprint = True
-
-    if should_fetch_imprint:
-        # Fetch outside the lock to avoid blocking other threads
+    # Get imprint text (cached per domain)
+    if domain not in imprint_text_cache:
         print(f"  [{row_idx}] Fetching imprint text for {domain}...")
-        imprint_text = get_imprint_text_for_domain(domain)
-        with imprint_lock:
-            imprint_text_cache[domain] = imprint_text
-            imprint_fetching.discard(domain)
-    elif imprint_text is None:
-        # Another thread is fetching, wait a bit and retry
-        time.sleep(0.5)
-        with imprint_lock:
-            if domain in imprint_text_cache:
-                imprint_text = imprint_text_cache[domain]
+        imprint_text_cache[domain] = get_imprint_text_for_domain(domain)
+    imprint_text = imprint_text_cache[domain]
 
     if not imprint_text:
         print(f"  [{row_idx}] ⚠ No imprint text found → skipping GPT for this domain.")
         return (row_idx, row, False)
 
-    # GPT call (cached per domain, thread-safe)
-    gpt_data = None
-    should_fetch_gpt = False
-
-    with domain_lock:
-        if domain in domain_cache:
-            gpt_data = domain_cache[domain]
-        elif domain not in domain_fetching:
-            # Mark as fetching to prevent duplicate requests
-            domain_fetching.add(domain)
-            should_fetch_gpt = True
-
-    if should_fetch_gpt:
-        # Fetch outside the lock to avoid blocking other threads
+    # GPT call (cached per domain)
+    if domain not in domain_cache:
         print(f"  [{row_idx}] Calling GPT for structured extraction...")
-        gpt_data = call_gpt_for_imprint(domain, company, imprint_text)
-        with domain_lock:
-            domain_cache[domain] = gpt_data
-            domain_fetching.discard(domain)
-    elif gpt_data is None:
-        # Another thread is fetching, wait a bit and retry
-        time.sleep(0.5)
-        with domain_lock:
-            if domain in domain_cache:
-                gpt_data = domain_cache[domain]
+        domain_cache[domain] = call_gpt_for_imprint(domain, company, imprint_text)
+    gpt_data = domain_cache[domain]
 
     # Apply updates
     updated = False
@@ -721,6 +676,23 @@ def transform_csv_to_new_format(input_csv: str, output_csv: str):
     print(f"   Transformed {len(transformed_rows)} rows")
 
 
+def process_domain(
+    indices: List[int],
+    rows: List[Dict[str, str]],
+    total_rows: int,
+) -> List[Tuple[int, Dict[str, str], bool]]:
+    """
+    Process all rows sharing one domain in order, so its imprint is fetched and sent to GPT
+    at most once. Returns one (row_idx, updated_row, was_updated) per row.
+    """
+    imprint_text_cache: Dict[str, Optional[str]] = {}
+    domain_cache: Dict[str, Dict[str, Any]] = {}
+    return [
+        process_row(rows[i], i + 1, total_rows, imprint_text_cache, domain_cache)
+        for i in indices
+    ]
+
+
 def enrich_with_gpt(input_csv: str, output_csv: str, max_workers: Optional[int] = None):
     """
     Enrich CSV with GPT-extracted data from website imprints.
@@ -779,15 +751,13 @@ def enrich_with_gpt(input_csv: str, output_csv: str, max_workers: Optional[int]
     if max_workers is None:
         max_workers = MAX_WORKERS_HTTP
 
-    # Thread-safe caches with locks
-    imprint_text_cache: Dict[str, Optional[str]] = {}
-    domain_cache: Dict[str, Dict[str, Any]] = {}
-    imprint_fetching: set = set()
-    domain_fetching: set = set()
-    imprint_lock = Lock()
-    domain_lock = Lock()
+    # Group rows by domain: one task per domain, so fetches and GPT calls are never duplicated
+    domain_to_indices: Dict[str, List[int]] = {}
+    for i, row in enumerate(rows):
+        domain = (row.get(COL_DOMAIN) or "").strip()
+        domain_to_indices.setdefault(domain, []).append(i)
 
-    # Process rows in parallel
+    # Process domains in parallel
     total_rows = len(rows)
     # Start with the original rows, so partial writes always contain something for every row
     processed_rows = rows.copy()  # <-- CHANGED: use original rows as baseline
@@ -801,42 +771,34 @@ def enrich_with_gpt(input_csv: str, output_csv: str, max_workers: Optional[int]
     partial_path = output_csv + ".partial"  # <-- CHANGED: partial file path
 
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all tasks
-        future_to_row = {
-            executor.submit(
-                process_row,
-                row,
-                i + 1,
-                total_rows,
-                imprint_text_cache,
-                domain_cache,
-                imprint_fetching,
-                domain_fetching,
-                imprint_lock,
-                domain_lock,
-            ): i
-            for i, row in enumerate(rows)
+        # Submit one task per domain
+        future_to_indices = {
+            executor.submit(process_domain, indices, rows, total_rows): indices
+            for indices in domain_to_indices.values()
         }
 
         # Collect results as they complete with progress bar
         completed = 0
+        last_checkpoint = 0
         with tqdm(total=total_rows, desc="Processing rows", unit="row") as pbar:
-            for future in as_completed(future_to_row):
+            for future in as_completed(future_to_indices):
+                indices = future_to_indices[future]
                 try:
-                    row_idx, updated_row, was_updated = future.result()
-                    processed_rows[row_idx - 1] = updated_row
-                    completed += 1
-                    pbar.update(1)
+                    for row_idx, updated_row, was_updated in future.result():
+                        processed_rows[row_idx - 1] = updated_row
+                    completed += len(indices)
+                    pbar.update(len(indices))
 
                     # Periodically write a partial checkpoint CSV
-                    if completed % 100 == 0:  # <-- CHANGED: write every 10 rows
+                    if completed - last_checkpoint >= 100:
+                        last_checkpoint = completed
                         print(f"\n💾 Writing partial checkpoint to {partial_path} ({completed}/{total_rows})\n")
                         _write_csv(partial_path, fieldnames, processed_rows)
                 except Exception as e:
-                    original_idx = future_to_row[future]
-                    print(f"\n❌ Error processing row {original_idx + 1}: {e}")
-                    processed_rows[original_idx] = rows[original_idx]  # Keep original on error
-                    pbar.update(1)
+                    print(f"\n❌ Error processing rows {', '.join(str(i + 1) for i in indices)}: {e}")
+                    for original_idx in indices:
+                        processed_rows[original_idx] = rows[original_idx]  # Keep original on error
+                    pbar.update(len(indices))
 
                     # Also checkpoint after an error
                     print(f"\n💾 Writing partial checkpoint to {partial_path} after error\n")